@@ -0,0 +1,608 @@
+'''
+Benchmarks for the Schelling engines in "How diverse can spatial measures of cultural diversity be? Results from Monte Carlo simulations of an agent-based model", by Dani
+Arribas-Bel, Peter Nijkamp and Jacques Poot
+Author: Dani Arribas-Bel <daniel.arribas.bel@gmail.com>
+...
+
+Copyright (c) 2015, Daniel Arribas-Bel
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+
+* The name of Daniel Arribas-Bel may not be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+---
+
+Timing of the different Schelling engines, of the geometries they run on,
+of the processing of their results and of their scaling with workers
+
+NOTE: run from the command line as
+
+    > python benchmarks.py [--save]
+
+Results are written to `bench_results.csv` and compared against
+`bench_baseline.csv` if it exists (the script exits with an error if any
+metric regressed). With `--save`, they become the new baseline instead
+
+'''
+
+import os
+import sys
+import time
+import shutil
+import pickle
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import pysal as ps
+from schelling import World, ArrayWorld, BlockWorld, TickProfiler, \
+        bounded_world, bounded_world_from_shapefile
+from sim_engine_scoop import god_multi_reps, Executor
+import results
+
+engines = {'agents': (World, {}), \
+           'incremental': (ArrayWorld, {'backend': 'incremental'}), \
+           'sparse': (ArrayWorld, {'backend': 'sparse'}), \
+           'block': (BlockWorld, {})}
+
+def bench_backends(dims=[(70, 70), (100, 100), (500, 500)], \
+        engine_names=['agents', 'incremental', 'sparse'], block=10, \
+        tau=0.5, prop_groups=[0.3, 0.3], vacant=0.25, ticks=10):
+    '''
+    Time setup and ticks of every engine on bounded worlds of different sizes
+    ...
+
+    Arguments
+    ---------
+    dims            : list
+                      Tuples with number of pixel rows and columns of each
+                      world
+    engine_names    : list
+                      Keys in `engines` to time
+    block           : int
+                      Number of pixels on each side of a neighborhood (kept
+                      fixed so the number of neighbors per agent does not
+                      change with the size of the world)
+    tau             : float
+                      Proportion of similar neighbors wanted
+    prop_groups     : list
+                      Proportions of population for each n-1 groups
+    vacant          : float
+                      Share of pixels left vacant
+    ticks           : int
+                      Maximum number of ticks to time (fewer if the world
+                      converges before)
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table with one row per world size and engine, with
+                      setup time, ticks run and seconds per tick
+    '''
+    out = []
+    for r, c in dims:
+        w, ns, xys = bounded_world(r, c, r / block, c / block)
+        _ = w.sparse # Cached in `w`, built here so no engine pays for it
+        pop_size = int(round((1 - vacant) * w.n))
+        for name in engine_names:
+            engine, kws = engines[name]
+            np.random.seed(1234)
+            t0 = time.time()
+            world = engine(pop_size, tau, prop_groups, w, neighs=ns, \
+                    max_iter=ticks - 1, **kws)
+            t1 = time.time()
+            world.go()
+            t2 = time.time()
+            out.append({'dims': '%ix%i'%(r, c), 'engine': name, \
+                    'setup_s': t1 - t0, 'ticks': world.ticks, \
+                    'tick_s': (t2 - t1) / max(world.ticks, 1)})
+            print "%ix%i | %s: %.4f seconds/tick"%(r, c, name, \
+                    out[-1]['tick_s'])
+    out = pd.DataFrame(out).set_index(['dims', 'engine'])
+    return out[['setup_s', 'ticks', 'tick_s']]
+
+def bench_world(dims=[(50, 50), (100, 100), (200, 200)], \
+        vacancies=[0.1, 0.25], taus=[0.3, 0.5], \
+        mixes=[[0.5], [0.3, 0.3]], engine_names=['incremental', 'block'], \
+        block=10, max_ticks=100, seed=1234):
+    '''
+    Time setup and `go` of engines over every combination of world size,
+    vacancy rate, tau and group mix. Every case runs in a fresh interpreter
+    (see `_isolated`), so its peak memory does not carry over what this
+    process holds
+    ...
+
+    Arguments
+    ---------
+    dims            : list
+                      Tuples with number of pixel rows and columns of each
+                      world
+    vacancies       : list
+                      Shares of pixels left vacant
+    taus            : list
+                      Proportions of similar neighbors wanted
+    mixes           : list
+                      Proportions of population for each n-1 groups
+    engine_names    : list
+                      Keys in `engines` to time
+    block           : int
+                      Number of pixels on each side of a neighborhood
+    max_ticks       : int
+                      Maximum number of ticks to run (fewer if the world
+                      converges before)
+    seed            : int
+                      Seed of every run
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table with one row per case, with setup time, ticks
+                      run, ticks and agents moved per second, share of time
+                      in every stage of a tick (see `TickProfiler`) and
+                      peak RSS (MB) of the process (rates are missing if
+                      no tick was needed)
+    '''
+    out = []
+    for r, c in dims:
+        for vacant in vacancies:
+            for tau in taus:
+                for prop_groups in mixes:
+                    for name in engine_names:
+                        row = _isolated(_world_case, name, r, c, block, \
+                                vacant, tau, prop_groups, max_ticks, seed)
+                        row.update({'dims': '%ix%i'%(r, c), \
+                                'engine': name, 'vacant': vacant, \
+                                'tau': tau, 'prop_mix': _mix(prop_groups)})
+                        out.append(row)
+                        print "%ix%i | %s | vacant %.2f | tau %.2f | %s: "\
+                                "%.1f ticks/s"%(r, c, name, vacant, tau, \
+                                row['prop_mix'], row['ticks_per_s'])
+    keys = ['dims', 'engine', 'vacant', 'tau', 'prop_mix']
+    cols = ['setup_s', 'ticks', 'ticks_per_s', 'movers_per_s'] + \
+            ['pct_' + stage for stage in TickProfiler.stages] + ['peak_rss_mb']
+    return pd.DataFrame(out).set_index(keys)[cols]
+
+def _world_case(name, r, c, block, vacant, tau, prop_groups, max_ticks, seed):
+    engine, kws = engines[name]
+    w, ns, xys = bounded_world(r, c, r / block, c / block, \
+            build_w=(name != 'block'))
+    pop_size = int(round((1 - vacant) * ns.shape[0]))
+    t0 = time.time()
+    world = engine(pop_size, tau, prop_groups, w, neighs=ns, \
+            max_iter=max_ticks - 1, rng=np.random.RandomState(seed), **kws)
+    t1 = time.time()
+    profiler = TickProfiler()
+    world.go(observer=profiler)
+    t2 = time.time()
+    # Rates are left missing if the world was happy from the start
+    row = {'setup_s': t1 - t0, 'ticks': world.ticks, \
+            'ticks_per_s': np.nan, 'movers_per_s': np.nan}
+    for stage in TickProfiler.stages:
+        row['pct_' + stage] = np.nan
+    if world.ticks:
+        summary = profiler.summary()
+        row['ticks_per_s'] = world.ticks / (t2 - t1)
+        row['movers_per_s'] = summary['movers'] / (t2 - t1)
+        for stage in TickProfiler.stages:
+            row['pct_' + stage] = summary[stage] / summary['total']
+    return row
+
+def bench_geometry(dims=[(100, 100), (300, 300)], pixels=[10000, 100000], \
+        block=10, polygons=(10, 10), seed=1234):
+    '''
+    Time the creation of geometries: `bounded_world` over grids of
+    different sizes and `bounded_world_from_shapefile` over a synthetic
+    shapefile (see `synthetic_shapefile`) with different numbers of pixels.
+    Every case runs in a fresh interpreter (see `_isolated`)
+    ...
+
+    Arguments
+    ---------
+    dims            : list
+                      Tuples with number of pixel rows and columns of each
+                      grid
+    pixels          : list
+                      Number of pixels to place in the shapefile
+    block           : int
+                      Number of pixels on each side of a neighborhood in
+                      grids
+    polygons        : tuple
+                      Rows and columns of polygons in the shapefile
+    seed            : int
+                      Seed for the shapefile and the location of pixels
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table with one row per case, with seconds taken and
+                      peak RSS (MB) of the process
+    '''
+    out = []
+    for r, c in dims:
+        row = _isolated(_grid_case, r, c, block)
+        row.update({'geometry': 'grid', 'size': r * c})
+        out.append(row)
+        print "grid %ix%i: %.4f seconds"%(r, c, row['time_s'])
+    folder = tempfile.mkdtemp()
+    try:
+        shp = synthetic_shapefile(os.path.join(folder, 'synthetic.shp'), \
+                polygons[0], polygons[1], seed=seed)
+        for n in pixels:
+            row = _isolated(_shapefile_case, shp, n, seed)
+            row.update({'geometry': 'shapefile', 'size': n})
+            out.append(row)
+            print "shapefile %i pixels: %.4f seconds"%(n, row['time_s'])
+    finally:
+        shutil.rmtree(folder)
+    return pd.DataFrame(out).set_index(['geometry', 'size'])[['time_s', \
+            'peak_rss_mb']]
+
+def _grid_case(r, c, block):
+    t0 = time.time()
+    w, ns, xys = bounded_world(r, c, r / block, c / block)
+    return {'time_s': time.time() - t0}
+
+def _shapefile_case(shp, n, seed):
+    t0 = time.time()
+    w, ns, xys = bounded_world_from_shapefile(shp, n, seed=seed)
+    return {'time_s': time.time() - t0}
+
+def synthetic_shapefile(path, nr=10, nc=10, size=100., seed=1234):
+    '''
+    Write a shapefile (plus dbf with an 'ID' column) with a grid of `nr` by
+    `nc` polygons with their corners shaken at random, so they have
+    different areas and are not aligned with their bounding box. Every
+    third polygon has a hole in the middle
+    ...
+
+    Arguments
+    ---------
+    path            : str
+                      Path to the .shp file to write
+    nr              : int
+                      Rows of polygons
+    nc              : int
+                      Columns of polygons
+    size            : float
+                      Side of the cells of the grid
+    seed            : int
+                      Seed for the shaking of corners
+
+    Returns
+    -------
+    path            : str
+                      Path to the .shp file
+    '''
+    rng = np.random.RandomState(seed)
+    shake = rng.uniform(-0.3, 0.3, size=(nr + 1, nc + 1, 2)) * size
+    shake[[0, -1], :, :] = 0
+    shake[:, [0, -1], :] = 0
+    x, y = np.indices((nr + 1, nc + 1)) * size
+    corners = np.dstack((x, y)) + shake
+    shp = ps.open(path, 'w')
+    dbf = ps.open(path.replace('.shp', '.dbf'), 'w')
+    dbf.header = ['ID']
+    dbf.field_spec = [('N', 9, 0)]
+    for i in range(nr):
+        for j in range(nc):
+            ring = [corners[i, j], corners[i, j+1], corners[i+1, j+1], \
+                    corners[i+1, j], corners[i, j]]
+            ring = [tuple(p) for p in ring]
+            holes = None
+            if (i * nc + j) % 3 == 0:
+                cx, cy = np.mean(ring[:-1], axis=0)
+                h = size / 8.
+                holes = [[(cx - h, cy - h), (cx + h, cy - h), \
+                        (cx + h, cy + h), (cx - h, cy + h), (cx - h, cy - h)]]
+            shp.write(ps.cg.Polygon(ring, holes=holes))
+            dbf.write([i * nc + j])
+    shp.close()
+    dbf.close()
+    return path
+
+def bench_results(reps=100, neighs=100, taus=[0.1, 0.3, 0.5, 0.7], \
+        mixes=[[0.5], [0.3, 0.3]], jobs=3, workers=[1, 2, 4], seed=1234):
+    '''
+    Time `results.process_map` on a table of simulated maps written to disk
+    and `results.process_job` on a job table with `jobs` jobs, the latter
+    with a process `Executor` of every number of `workers`. Maps are made
+    up (random counts), only their shape matters
+    ...
+
+    Arguments
+    ---------
+    reps            : int
+                      Replications per (tau, proportions)
+    neighs          : int
+                      Neighborhoods per map
+    taus            : list
+                      Values of tau
+    mixes           : list
+                      Proportions of population for each n-1 groups
+    jobs            : int
+                      Number of jobs in the job table
+    workers         : list
+                      Numbers of workers to run `process_job` with
+    seed            : int
+                      Seed for the counts
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table with one row per case, with seconds taken, maps
+                      processed per second and speedup over the first
+                      number of `workers`
+    '''
+    rng = np.random.RandomState(seed)
+    tab = _fake_maps(rng, reps, neighs, taus, mixes)
+    n_maps = tab.groupby(['tau', 'prop_mix', 'rep_id']).ngroups
+    out = []
+    folder = tempfile.mkdtemp()
+    try:
+        link = os.path.join(folder, 'maps.csv')
+        tab.to_csv(link, index=False)
+        t0 = time.time()
+        _ = results.process_map(link)
+        t1 = time.time()
+        out.append({'function': 'process_map', 'workers': 1, \
+                'time_s': t1 - t0})
+    finally:
+        shutil.rmtree(folder)
+    job = pd.concat([tab.assign(job=j, city='c%i'%j, vacr=0.1 * (j + 1)) \
+            for j in range(jobs)])
+    for k in workers:
+        executor = Executor('processes', workers=k)
+        t0 = time.time()
+        _ = results.process_job(job, executor=executor)
+        t1 = time.time()
+        executor.shutdown()
+        out.append({'function': 'process_job', 'workers': k, \
+                'time_s': t1 - t0})
+    out = pd.DataFrame(out).set_index(['function', 'workers'])
+    maps = pd.Series([n_maps] + [n_maps * jobs] * len(workers), \
+            index=out.index)
+    out['maps_per_s'] = maps / out['time_s']
+    first = out['time_s'].groupby(level='function').transform('first')
+    out['speedup'] = first / out['time_s']
+    print out
+    return out
+
+def _fake_maps(rng, reps, neighs, taus, mixes):
+    '''
+    Table of random maps in the format written by `god_multi_reps`
+    '''
+    out = []
+    for prop_groups in mixes:
+        k = len(prop_groups) + 1
+        for tau in taus:
+            counts = rng.randint(0, 40, size=(reps * neighs, k))
+            tab = pd.DataFrame(counts.astype(float), \
+                    columns=['g%i'%g for g in range(k)])
+            tab['group'] = ['n%i'%n for n in range(neighs)] * reps
+            tab['rep_id'] = np.repeat(np.arange(reps), neighs)
+            tab['ticks'] = 5
+            tab['tau'] = tau
+            tab['prop_mix'] = _mix(prop_groups)
+            out.append(tab)
+    return pd.concat(out)
+
+def bench_scaling(workers=[1, 2, 4], dims=(100, 100), block=10, reps=16, \
+        taus=[0.3, 0.5], mixes=[[0.3, 0.3]], engine='block', vacant=0.25, \
+        max_iter=1000, seed=1234):
+    '''
+    Time a whole sweep (`god_multi_reps`) on a process `Executor` with
+    every number of `workers`
+    ...
+
+    Arguments
+    ---------
+    workers         : list
+                      Numbers of workers
+    dims            : tuple
+                      Number of pixel rows and columns of the world
+    block           : int
+                      Number of pixels on each side of a neighborhood
+    reps            : int
+                      Replications per (tau, proportions)
+    taus            : list
+                      Values of tau
+    mixes           : list
+                      Proportions of population for each n-1 groups
+    engine          : str
+                      Key in `schelling.engines` to run replications with
+    vacant          : float
+                      Share of pixels left vacant
+    max_iter        : int
+                      Maximum number of ticks of every replication
+    seed            : int
+                      Master seed of the sweep
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table with one row per number of workers, with
+                      seconds taken, replications per second and speedup
+                      over the first number of `workers`
+    '''
+    config = {'Yi': dims[0], 'Xi': dims[1], 'Yn': dims[0] / block, \
+            'Xn': dims[1] / block, 'vacant': vacant, 'replications': reps, \
+            'seed': seed, 'engine': engine}
+    out = []
+    for k in workers:
+        executor = Executor('processes', workers=k)
+        t0 = time.time()
+        _ = god_multi_reps(taus, mixes, config, max_iter=max_iter, \
+                executor=executor)
+        t1 = time.time()
+        executor.shutdown()
+        out.append({'workers': k, 'time_s': t1 - t0})
+    out = pd.DataFrame(out).set_index('workers')
+    out['reps_per_s'] = reps * len(taus) * len(mixes) / out['time_s']
+    out['speedup'] = out['time_s'].iloc[0] / out['time_s']
+    print out
+    return out
+
+def _mix(prop_groups):
+    return '_'.join(map(str, prop_groups + [1. - sum(prop_groups)]))
+
+def _isolated(fun, *args):
+    '''
+    Run `fun(*args)` in a fresh interpreter and return its output (a dict)
+    with the peak RSS (MB) of that interpreter added as 'peak_rss_mb' (see
+    `_peak_rss_mb`). A forked process would start with (and count) the
+    memory of this one, so the case and its arguments are passed through a
+    pickle instead. The peak includes the modules imported by the
+    interpreter, the same for every case
+    '''
+    fd, path = tempfile.mkstemp(suffix='.pkl')
+    os.close(fd)
+    try:
+        with open(path, 'wb') as fo:
+            pickle.dump((fun.func_name, args), fo, -1)
+        code = 'import benchmarks; benchmarks._measured(%r)'%path
+        subprocess.check_call([sys.executable, '-c', code], \
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(path, 'rb') as fo:
+            return pickle.load(fo)
+    finally:
+        os.remove(path)
+
+def _measured(path):
+    '''
+    Run the case pickled in `path` by `_isolated` and write back its output
+    '''
+    with open(path, 'rb') as fo:
+        name, args = pickle.load(fo)
+    row = globals()[name](*args)
+    row['peak_rss_mb'] = _peak_rss_mb()
+    with open(path, 'wb') as fo:
+        pickle.dump(row, fo, -1)
+
+def _peak_rss_mb():
+    '''
+    Peak RSS (MB) of this process. On Linux, read from the high water mark
+    of its address space (`VmHWM`), as `ru_maxrss` survives `exec` and
+    would report the peak of the process it was forked from if larger
+    '''
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as fo:
+            for line in fo:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    # Kilobytes on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024.
+    return rss / 1024.
+
+def stack_benchmarks(outs):
+    '''
+    Stack the output of several benchmarks in long form
+    ...
+
+    Arguments
+    ---------
+    outs            : dict
+                      Output of every benchmark (DataFrame indexed on the
+                      keys of every case) keyed on the name of the suite
+
+    Returns
+    -------
+    out             : DataFrame
+                      Table indexed on suite, case (keys of the case joined
+                      by '|') and metric with a 'value' column
+    '''
+    stacked = []
+    for suite, out in outs.iteritems():
+        out = out.copy()
+        out.index = ['|'.join(map(str, i)) if isinstance(i, tuple) else \
+                str(i) for i in out.index]
+        out = out.stack().reset_index()
+        out.columns = ['case', 'metric', 'value']
+        out['suite'] = suite
+        stacked.append(out)
+    return pd.concat(stacked).set_index(['suite', 'case', 'metric'])
+
+def compare_baseline(out, baseline, tol=0.25):
+    '''
+    Metrics in `out` that got worse than in `baseline` by more than `tol`.
+    Throughputs ('_per_s') and speedups are worse if lower, times ('_s')
+    and memory ('_mb') if higher; the rest (e.g. ticks run) are not checked
+    ...
+
+    Arguments
+    ---------
+    out             : DataFrame
+                      Current results, as returned by `stack_benchmarks`
+    baseline        : DataFrame
+                      Baseline results, as returned by `stack_benchmarks`
+    tol             : float
+                      [Optional. Default=0.25] Relative change tolerated
+
+    Returns
+    -------
+    regressions     : DataFrame
+                      Table with baseline and current value and relative
+                      change of every metric regressed
+    '''
+    both = baseline[['value']].join(out[['value']], how='inner', \
+            lsuffix='_baseline', rsuffix='_current')
+    both.columns = ['baseline', 'current']
+    both['change'] = (both['current'] - both['baseline']) / both['baseline']
+    metric = pd.Series(both.index.get_level_values('metric'), \
+            index=both.index)
+    higher = metric.str.endswith('_per_s') | (metric == 'speedup')
+    lower = ~higher & (metric.str.endswith('_s') | \
+            metric.str.endswith('_mb'))
+    worse = (higher & (both['change'] < -tol)) | \
+            (lower & (both['change'] > tol))
+    return both[worse]
+
+if __name__ == '__main__':
+
+    outs = {}
+    outs['backends'] = bench_backends()
+    outs['world'] = bench_world()
+    outs['geometry'] = bench_geometry()
+    outs['results'] = bench_results()
+    outs['scaling'] = bench_scaling()
+    out = stack_benchmarks(outs)
+    out.to_csv('bench_results.csv')
+    if '--save' in sys.argv:
+        out.to_csv('bench_baseline.csv')
+        print "Baseline saved to bench_baseline.csv"
+    elif os.path.exists('bench_baseline.csv'):
+        baseline = pd.read_csv('bench_baseline.csv', \
+                index_col=['suite', 'case', 'metric'])
+        regressions = compare_baseline(out, baseline)
+        if regressions.shape[0]:
+            print "Regressions against bench_baseline.csv:"
+            print regressions
+            sys.exit(1)
+        print "No regressions against bench_baseline.csv"
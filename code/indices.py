@@ -0,0 +1,174 @@
+'''
+Vectorized diversity indices for "How diverse can spatial measures of cultural diversity be? Results from Monte Carlo simulations of an agent-based model", by Dani
+Arribas-Bel, Peter Nijkamp and Jacques Poot
+Author: Dani Arribas-Bel <daniel.arribas.bel@gmail.com>
+...
+
+Copyright (c) 2015, Daniel Arribas-Bel
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+
+* The name of Daniel Arribas-Bel may not be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+---
+
+NumPy versions of the spatial diversity indices in
+`pysal.inequality._indices` that take a stack of maps at once. Every
+function takes an array `x` of counts shaped (..., N, k): N neighborhoods
+(rows) and k groups (columns), with any number of leading dimensions (e.g.
+maps x N x k), and returns an array (..., k) with the index for every group
+(`theil_th`, with one value per map, returns an array (...)). Formulas and
+names follow those in pysal, so results are the same as calling them on one
+map at a time.
+
+NOTE: run from the command line as
+
+    > python indices.py
+
+to check results against pysal.
+
+'''
+
+import numpy as np
+
+SMALL = np.finfo('float').tiny
+
+def _totals(x):
+    '''
+    Area (..., N), group (..., k) and overall (...) totals
+    '''
+    x = np.asarray(x, dtype=float)
+    pa = x.sum(axis=-1)
+    pg = x.sum(axis=-2)
+    p = pg.sum(axis=-1)
+    return x, pa, pg, p
+
+def segregation_gsg(x):
+    '''
+    Segregation index GS (Duncan & Duncan index of a group against the rest
+    combined)
+    '''
+    x, pa, pg, p = _totals(x)
+    first = x / pg[..., None, :]
+    second = (pa[..., :, None] - x) / (p[..., None] - pg)[..., None, :]
+    return 0.5 * np.abs(first - second).sum(axis=-2)
+
+def modified_segregation_msg(x):
+    '''
+    Modified segregation index MS (GSg as used by Van Mourik et al., 1989)
+    '''
+    x, pa, pg, p = _totals(x)
+    pgp = pg / p[..., None]
+    return 2. * pgp * (1. - pgp) * segregation_gsg(x)
+
+def isolation_isg(x):
+    '''
+    Isolation index IS
+    '''
+    x, pa, pg, p = _totals(x)
+    ws = x / pg[..., None, :]
+    pgapa = x / pa[..., :, None]
+    pgp = pg / p[..., None]
+    return (ws * pgapa / pgp[..., None, :]).sum(axis=-2)
+
+def isolation_ii(x):
+    '''
+    Isolation index II_g
+    '''
+    x, pa, pg, p = _totals(x)
+    pgp = pg / p[..., None]
+    block = (x / pg[..., None, :] * (x / pa[..., :, None])).sum(axis=-2)
+    return (block / pgp - pgp) / (1. - pgp)
+
+def theil_th(x, ridz=True):
+    '''
+    Theil index TH (one value per map). If `ridz`, a small amount is added
+    to zero counts to avoid zero divisions
+    '''
+    x = np.asarray(x, dtype=float)
+    if ridz:
+        x = x + SMALL * (x == 0)
+    x, pa, pg, p = _totals(x)
+    pgp = pg / p[..., None]
+    share = x / pa[..., :, None]
+    num = share * (np.log(pgp)[..., None, :] - np.log(share))
+    den = (pgp * np.log(pgp)).sum(axis=-1)
+    th = (pa / p[..., None])[..., :, None] * num / den[..., None, None]
+    return th.sum(axis=-1).sum(axis=-1)
+
+def gini_gig(x):
+    '''
+    Gini GI index of the distribution of every group over neighborhoods
+    '''
+    ys = np.sort(np.asarray(x, dtype=float), axis=-2)
+    n = ys.shape[-2]
+    num = 2. * ((np.arange(n) + 1.)[:, None] * ys).sum(axis=-2)
+    den = n * ys.sum(axis=-2)
+    return num / den - (n + 1.) / n
+
+def ellison_glaeser_egg_pop(x):
+    '''
+    Ellison and Glaeser (1997) index of concentration, for people rather
+    than industries (Mare et al., 2012)
+    '''
+    x, pa, pg, p = _totals(x)
+    pap = pa / p[..., None]
+    num1n = ((x / pg[..., None, :] - pap[..., :, None])**2).sum(axis=-2)
+    num1d = 1. - (pap**2).sum(axis=-1)
+    opg = 1. / pg
+    return (num1n / num1d[..., None] - opg) / (1. - opg)
+
+def maurel_sedillot_msg_pop(x):
+    '''
+    Maurel and Sedillot (1999) index of concentration, for people rather
+    than industries (Mare et al., 2012)
+    '''
+    x, pa, pg, p = _totals(x)
+    pap = pa / p[..., None]
+    num1n = ((x / pg[..., None, :])**2 - (pap**2)[..., :, None]).sum(axis=-2)
+    num1d = 1. - (pap**2).sum(axis=-1)
+    opg = 1. / pg
+    return (num1n / num1d[..., None] - opg) / (1. - opg)
+
+if __name__ == '__main__':
+
+    import time
+    from pysal.inequality import _indices as I
+
+    np.random.seed(1234)
+    maps = np.random.randint(0, 60, (500, 49, 4))
+    for name in ['segregation_gsg', 'modified_segregation_msg', \
+            'isolation_isg', 'isolation_ii', 'theil_th', 'gini_gig', \
+            'ellison_glaeser_egg_pop', 'maurel_sedillot_msg_pop']:
+        t0 = time.time()
+        ref = np.array([getattr(I, name)(x.copy()) for x in maps])
+        t1 = time.time()
+        vec = globals()[name](maps)
+        t2 = time.time()
+        print "%s | max. abs. difference: %.2e | pysal: %.4f s | stack: %.4f s"\
+                %(name.ljust(24), np.abs(ref - vec).max(), t1 - t0, t2 - t1)
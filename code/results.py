@@ -40,12 +40,13 @@ POSSIBILITY OF SUCH DAMAGE.
 Process results from ABM simulations
 '''
 
-import time
+import os, time
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.stats import moment
-from pysal.inequality import _indices as I
+import indices as V
+from sim_io import ResultSink
 
 walk = {'0.5_0.5': 'Benchmark', \
         '0.7_0.3': 'Single minority', \
@@ -56,9 +57,11 @@ walk = {'0.5_0.5': 'Benchmark', \
 
 def process_map(map_table_link):
     '''
-    Map processor that calculates diversity indices. Processor happens
-    sequentially as the file is read in chunks (this makes it substantially
-    slower but scalable).
+    Map processor that calculates diversity indices. The table is read in
+    one pass and maps are told apart by their (tau, prop_mix, rep_id) keys,
+    not by a fixed number of rows, so any number of neighborhoods per map
+    is supported. Maps are then stacked by proportions and indices
+    computed for all of them at once (see `stack_maps` and `map_indices`).
     ...
 
     Arguments
@@ -67,7 +70,9 @@ def process_map(map_table_link):
                       Path to table from simulations indexed on tau, prop_mix,
                       and group (neighborhood) and with counts for each
                       population group. It also includes `ticks` but this is
-                      dropped at this stage.
+                      dropped at this stage. Alternatively, path to the
+                      folder of a `ResultSink` in 'csv' or 'npy' format
+                      (see `process_store`)
 
     Returns
     -------
@@ -76,34 +81,170 @@ def process_map(map_table_link):
                       This is indexed on tau, prop_mix, rep_id and group and
                       contains a column for each index calculated.
     '''
+    if os.path.isdir(map_table_link):
+        return process_store(map_table_link)
     t0 = time.time()
-    reader = pd.read_csv(map_table_link, index_col=[0, 1, 3], chunksize=49)
     print map_table_link
+    out = _table_indices(pd.read_csv(map_table_link))
+    t1 = time.time()
+    print '\t %.2f seconds'%(t1 - t0)
+    return out
+
+def _table_indices(tab):
+    keys = ['tau', 'prop_mix', 'rep_id']
+    out = [_long_indices(prop_mix, mkeys, X) for prop_mix, mkeys, X in \
+            stack_maps(tab, keys, extra=['ticks'])]
+    if not out:
+        raise Exception, "No converged maps to compute indices for"
+    return pd.concat(out).set_index(keys + ['group'])
+
+def process_store(store_link):
+    '''
+    Same as `process_map` but for output streamed to a `ResultSink`, whose
+    format is told from the files in the folder. In 'npy' format, counts of
+    every cell are memory-mapped and converged replications are taken
+    straight from the (rep, neighborhood, group) tensor, without parsing
+    any table. 'csv' sinks are read whole and processed as in
+    `process_map`.
+    ...
+
+    Arguments
+    ---------
+    store_link      : str
+                      Path to folder of the `ResultSink`
+
+    Returns
+    -------
+    i_table         : DataFrame
+                      Same as in `process_map`
+    '''
+    t0 = time.time()
+    exts = set([os.path.splitext(f)[1] for f in os.listdir(store_link)])
+    print store_link
+    if '.json' not in exts:
+        if '.csv' not in exts:
+            raise Exception, "'%s' is not the folder of a 'csv' or 'npy' "\
+                    "ResultSink"%store_link
+        out = _table_indices(ResultSink(store_link).read().reset_index())
+        t1 = time.time()
+        print '\t %.2f seconds'%(t1 - t0)
+        return out
+    store = ResultSink(store_link, format='npy')
     out = []
-    for mapa in reader:
-        rep_id = mapa['rep_id'].iloc[0]
-        inds = spatial_diversity(mapa.drop(['rep_id', 'ticks'], axis=1)\
-                .dropna(axis=1), rep_id)
-        inds['ticks'] = mapa['ticks'].iloc[0]
-        inds['tau'] = mapa.index.get_level_values('tau')[0]
-        prop_mix = mapa.index.get_level_values('prop_mix')[0]
-        inds['prop_mix'] = prop_mix
-        group_map = {'g%i'%g: 'g%i-%s'%(g, str(p).ljust(4, '0')) for g, p in \
-                enumerate(prop_mix.split('_'))}
-        inds['group'] = inds.index.values
-        inds['group'] = inds['group'].map(group_map)
-        inds = inds.set_index(['tau', 'prop_mix', 'rep_id', 'group'])
-        out.append(inds)
-    out = pd.concat(out)
+    for prop_mix, tau in sorted(store.partitions):
+        counts, meta = store.load(prop_mix, tau)
+        happy = np.array(meta['happy'], dtype=bool)
+        if not happy.any():
+            continue
+        mkeys = pd.DataFrame({'rep_id': np.array(meta['rep_id'])[happy], \
+                'ticks': np.array(meta['columns']['ticks'])[happy]})
+        mkeys['tau'] = tau
+        out.append(_long_indices(prop_mix, mkeys, \
+                np.asarray(counts[happy], dtype=float)))
+    if not out:
+        raise Exception, "No converged maps to compute indices for"
+    out = pd.concat(out).set_index(['tau', 'prop_mix', 'rep_id', 'group'])
     t1 = time.time()
     print '\t %.2f seconds'%(t1 - t0)
     return out
 
-def process_job(job):
+def stack_maps(tab, keys, extra=[]):
+    '''
+    Split a flat table of simulated maps into 3D (maps x neighborhoods x
+    groups) arrays of counts, one per proportions (and number of
+    neighborhoods per map, if it varies). Maps that did not converge
+    (counts missing) are left out.
+    ...
+
+    Arguments
+    ---------
+    tab             : DataFrame
+                      Table with one row per map and neighborhood, with
+                      `keys`, 'prop_mix', 'group' (neighborhood) and
+                      'g%i' columns with counts for each group
+    keys            : list
+                      Columns identifying a map (must include 'prop_mix')
+    extra           : list
+                      [Optional] Columns constant within a map to carry
+                      over (e.g. 'ticks')
+
+    Returns
+    -------
+    stacks          : list
+                      Tuples (prop_mix, mkeys, X) with a DataFrame with
+                      `keys` and `extra` of every map and its array of
+                      counts
+    '''
+    stacks = []
+    others = [k for k in keys if k != 'prop_mix']
+    for prop_mix, sub in tab.groupby('prop_mix'):
+        groups = ['g%i'%g for g in range(len(prop_mix.split('_')))]
+        sub = sub[sub[groups].notnull().all(axis=1)]
+        if sub.shape[0] == 0:
+            continue
+        sub = sub.set_index(others + ['group']).sortlevel()
+        sizes = sub.groupby(level=others).size()
+        starts = np.concatenate(([0], np.cumsum(sizes.values)[: -1]))
+        mkeys = sub[extra].iloc[starts].reset_index()[others + extra]
+        mkeys['prop_mix'] = prop_mix
+        counts = sub[groups].values.astype(float)
+        for size in np.unique(sizes.values):
+            maps = sizes.values == size
+            X = counts[np.repeat(maps, sizes.values)]
+            stacks.append((prop_mix, mkeys[maps], \
+                    X.reshape((maps.sum(), size, len(groups)))))
+    return stacks
+
+def map_indices(X):
+    '''
+    Spatial diversity indices (those in `spatial_diversity`) of a stack of
+    maps
+    ...
+
+    Arguments
+    ---------
+    X       : ndarray
+              (maps x neighborhoods x groups) array of counts
+
+    Returns
+    -------
+    out     : dict
+              (maps x groups) array of every index, keyed on its name
+              (indices with a single value per map, such as `theil_th`,
+              are repeated for every group)
+    '''
+    out = {}
+    for ind in spatial_indices:
+        vals = ind(X)
+        if vals.ndim == 1:
+            vals = np.repeat(vals[:, None], X.shape[2], axis=1)
+        out[ind.func_name] = vals
+    return out
+
+def _long_indices(prop_mix, mkeys, X):
+    '''
+    Indices of the stack of maps `X` in long form, with a row per map and
+    group (labelled as 'g%i-<proportion>') and the columns in `mkeys`
+    '''
+    M, N, G = X.shape
+    inds = map_indices(X)
+    out = pd.DataFrame({name: inds[name].ravel() for name in inds})
+    for col in mkeys.columns:
+        out[col] = np.repeat(mkeys[col].values, G)
+    out['prop_mix'] = prop_mix
+    out['group'] = np.tile(['g%i-%s'%(g, str(p).ljust(4, '0')) for g, p in \
+            enumerate(prop_mix.split('_'))], M)
+    return out
+
+def process_job(job, executor=None, chunks=None):
     '''
     Take results from a single job (from multi-vacancy/urban setup
     simulations) and calculate diversity indices.
 
+    The table is split by (job, tau) into chunks that are sent to the
+    workers of `executor`; within every chunk, maps are stacked and indices
+    computed for all of them at once (see `stack_maps` and `map_indices`).
+
     Arguments
     ---------
     job             : DataFrame
@@ -111,6 +252,14 @@ def process_job(job):
                       rep_id and group (neighborhood) and with counts for each
                       population group. It also includes `ticks` but this is
                       dropped at this stage.
+    executor        : Executor
+                      [Optional. Default=None] Backend to process chunks on
+                      (see `sim_engine_scoop.Executor`). If None, chunks
+                      are processed serially
+    chunks          : int
+                      [Optional. Default=None] Number of chunks to split
+                      the table into. If None, four per worker of
+                      `executor` (one if no `executor`)
 
     Returns
     -------
@@ -120,32 +269,56 @@ def process_job(job):
                       contains a column for each index calculated.
     '''
     t0 = time.time()
-    out = []
-    mapas = job.groupby(['job', 'tau', 'rep_id'])
-    for ids, mapa in mapas:
-        job, tau, rep_id = ids
-        mapa = mapa.set_index(['tau', 'prop_mix', 'group'])
-        todrop = ['rep_id', 'ticks', 'vacr', 'city', 'job']
-        x = mapa.drop(todrop, axis=1).dropna(axis=1)
-        inds = spatial_diversity(x, rep_id)
-        inds['ticks'] = mapa['ticks'].iloc[0]
-        inds['tau'] = tau
-        prop_mix = mapa.index.get_level_values('prop_mix')[0]
-        inds['prop_mix'] = prop_mix
-        inds['vacr'] = mapa['vacr'].iloc[0]
-        inds['city'] = mapa['city'].iloc[0]
-        inds['job'] = mapa['job'].iloc[0]
-        group_map = {'g%i'%g: 'g%i-%s'%(g, str(p).ljust(4, '0')) for g, p in \
-                enumerate(prop_mix.split('_'))}
-        inds['group'] = inds.index.values
-        inds['group'] = inds['group'].map(group_map)
-        inds = inds.set_index(['tau', 'prop_mix', 'rep_id', 'group'])
-        out.append(inds)
-    out = pd.concat(out)
+    if chunks is None:
+        chunks = 1 if executor is None else 4 * executor.workers
+    # Every map falls within a single (job, tau) block
+    blocks = [block for ids, block in job.groupby(['job', 'tau'])]
+    sizes = np.array([block.shape[0] for block in blocks])
+    # Largest blocks first, each to the lightest chunk so far
+    loads = np.zeros(min(chunks, len(blocks)))
+    parts = [[] for i in range(loads.shape[0])]
+    for b in np.argsort(-sizes):
+        i = loads.argmin()
+        parts[i].append(blocks[b])
+        loads[i] += sizes[b]
+    parts = [pd.concat(part) for part in parts]
+    if executor is None:
+        out = map(_process_job_chunk, parts)
+    else:
+        out = executor.map(_process_job_chunk, parts)
+    out = pd.concat([o for o in out if o is not None])
+    out = out.set_index(['tau', 'prop_mix', 'rep_id', 'group'])
+    inds = sorted([col for col in out.columns if col not in \
+            ['ticks', 'vacr', 'city', 'job']])
+    out = out[inds + ['ticks', 'vacr', 'city', 'job']]
     t1 = time.time()
     print '\t %.2f seconds'%(t1 - t0)
     return out
 
+def _process_job_chunk(chunk):
+    '''
+    Indices of every map in a chunk of a job table, in long form (see
+    `process_job`)
+    '''
+    stacks = stack_maps(chunk, ['job', 'tau', 'prop_mix', 'rep_id'], \
+            extra=['ticks', 'vacr', 'city'])
+    if not stacks:
+        return None
+    return pd.concat([_long_indices(prop_mix, mkeys, X) for \
+            prop_mix, mkeys, X in stacks])
+
+# Vectorized versions of those in `pysal.inequality._indices` (see
+# `indices.py`), which take one map or a stack of them
+spatial_indices = [ \
+        V.segregation_gsg, \
+        #V.modified_segregation_msg, \
+        V.theil_th, \
+        V.isolation_ii, \
+        #V.gini_gig, \
+        V.ellison_glaeser_egg_pop, \
+        #V.maurel_sedillot_msg_pop, \
+        ]
+
 def spatial_diversity(df, id=None):
     '''
     Calculate all diversity spatial indices from the output of one replication and
@@ -164,17 +337,8 @@ def spatial_diversity(df, id=None):
     out     : pd.Series
               Indices computed
     '''
-    indices = [ \
-            I.segregation_gsg, \
-            #I.modified_segregation_msg, \
-            I.theil_th, \
-            I.isolation_ii, \
-            #I.gini_gig, \
-            I.ellison_glaeser_egg_pop, \
-            #I.maurel_sedillot_msg_pop, \
-            ]
     out = pd.DataFrame({ind.func_name: pd.Series(ind(df.values), index=df.columns) \
-            for ind in indices})
+            for ind in spatial_indices})
     out.index.name = 'group'
     if id != None:
         out['rep_id'] = id
@@ -46,13 +46,24 @@ http://ccl.northwestern.edu/netlogo/models/Segregation
 
 '''
 
+import os
 import copy
+import time
+import json
+import shutil
+import hashlib
+import tempfile
 import pandas as pd
 import pysal as ps
 import numpy as np
-import multiprocessing as mp
+from scipy import sparse
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 from matplotlib import pyplot as plt
 from matplotlib.cm import get_cmap
+from matplotlib.path import Path
 
 class Agent():
     """
@@ -76,6 +87,156 @@ class Agent():
         self.happy = False
         self.similar_nearby = None
 
+class VacancyPool():
+    """
+    Pool of free pixels (referred to by position, 0 to n-1) that supports
+    taking out and putting back pixels, and drawing random ones, at a cost
+    that depends on the number of pixels involved and not on `n`. Free
+    pixels are kept in the first `size` slots of `cells` and `pos` indexes
+    where each of them is, so removals are swaps with the last free slot
+
+    Arguments
+    =========
+    n       : int
+              Number of pixels in the world
+    free    : array
+              [Optional] Pixels initially free. If None, all are free
+    rng     : np.random.RandomState
+              [Optional] Random state to draw cells from. If None, the
+              global one in `np.random`
+
+    Attributes
+    ==========
+    cells   : ndarray
+              Free pixels in `cells[: size]`
+    pos     : ndarray
+              Position in `cells` of every pixel (-1 if taken)
+    size    : int
+              Number of free pixels
+    """
+    def __init__(self, n, free=None, rng=None):
+        self.rng = np.random if rng is None else rng
+        if free is None:
+            free = np.arange(n)
+        free = np.asarray(free, dtype=int)
+        self.cells = np.zeros(n, dtype=int)
+        self.pos = -np.ones(n, dtype=int)
+        self._stamp = np.zeros(n, dtype=int)
+        self.size = free.shape[0]
+        self.cells[: self.size] = free
+        self.pos[free] = np.arange(self.size)
+
+    def release(self, cells):
+        """
+        Put `cells` (currently taken) back into the pool
+        """
+        cells = np.asarray(cells, dtype=int)
+        k = cells.shape[0]
+        self.cells[self.size: self.size + k] = cells
+        self.pos[cells] = np.arange(self.size, self.size + k)
+        self.size += k
+
+    def claim(self, cells):
+        """
+        Take `cells` (currently free) out of the pool
+        """
+        self._remove(self.pos[np.asarray(cells, dtype=int)])
+
+    def draw(self, r):
+        """
+        Take `r` random free cells out of the pool and return them (in random
+        order)
+        """
+        if 2 * r > self.size:
+            idx = self.rng.permutation(self.size)[: r]
+        else:
+            # Draw with replacement and keep one appearance of every slot
+            # until `r` are distinct (a uniform random subset in random
+            # order)
+            idx = np.zeros(0, dtype=int)
+            while idx.shape[0] < r:
+                idx = np.concatenate((idx, self.rng.randint(0, self.size, \
+                        r - idx.shape[0] + 1 + r / 8)))
+                order = np.arange(idx.shape[0])
+                self._stamp[idx] = order
+                idx = idx[self._stamp[idx] == order]
+            idx = idx[: r]
+        cells = self.cells[idx]
+        self._remove(idx)
+        return cells
+
+    def _remove(self, idx):
+        # Free cells in the last len(idx) slots that are not removed fill the
+        # holes left by removed ones before them
+        k = idx.shape[0]
+        self.pos[self.cells[idx]] = -1
+        tail = self.cells[self.size - k: self.size]
+        holes = idx[idx < self.size - k]
+        self.cells[holes] = tail[self.pos[tail] >= 0]
+        self.pos[self.cells[holes]] = holes
+        self.size -= k
+
+class TickProfiler():
+    '''
+    Observer to pass to the `go` method of an engine, recording for every
+    tick the seconds spent in each stage of the model, the number of agents
+    moved and the share of happy agents after the tick. Rows are kept as
+    tuples and only turned into a table when requested
+    ...
+
+    Stages (in order) are:
+
+        * select_unhappy    : find agents who are unhappy
+        * which_free        : release their pixels into the vacancy pool
+        * move_unhappy      : draw their new locations
+        * update_topo       : update neighbor counts around moves
+        * update_happiness  : recompute happiness of affected agents
+
+    NOTE: `LatticeWorld` runs a tick in a single kernel, whose time is
+    recorded under 'move_unhappy'
+
+    Attributes
+    ==========
+    rows                : list
+                          Tuples (tick, seconds by stage, movers, pct_happy)
+                          of every tick recorded
+    '''
+    stages = ['select_unhappy', 'which_free', 'move_unhappy', 'update_topo', \
+            'update_happiness']
+
+    def __init__(self):
+        self.rows = []
+
+    def tick(self, world, stamps, movers):
+        '''
+        Record a tick of `world` given the `stamps` (from `time.time`)
+        taken at the start of the tick and the end of every stage
+        '''
+        self.rows.append((world.ticks, ) + \
+                tuple(np.diff(stamps)) + (movers, world.pct_happy))
+
+    def trace(self):
+        '''
+        Table with a row per tick recorded, indexed on tick, with seconds
+        spent in every stage plus the 'movers' and 'pct_happy' columns
+        '''
+        cols = ['tick'] + self.stages + ['movers', 'pct_happy']
+        return pd.DataFrame(self.rows, columns=cols).set_index('tick')
+
+    def summary(self):
+        '''
+        Totals over ticks recorded: seconds spent in every stage and
+        overall, ticks, movers, ticks per second and movers per second
+        '''
+        trace = self.trace()
+        out = trace[self.stages].sum()
+        out['total'] = out.sum()
+        out['ticks'] = trace.shape[0]
+        out['movers'] = trace['movers'].sum()
+        out['ticks_per_s'] = out['ticks'] / out['total']
+        out['movers_per_s'] = out['movers'] / out['total']
+        return out
+
 class World():
     '''
     Controller of model
@@ -96,9 +257,10 @@ class World():
                           List with proportions of the population in each
                           group, except for the last one, which is calculated
                           as a residual
-    w                   : pysal.W
+    w                   : pysal.W/Topology
                           Spatial weights object for the world (n is all the
-                          possible locations in the world (pixels) to land on
+                          possible locations in the world (pixels) to land on.
+                          A RegionTopology is refused (see `BlockWorld`)
     neighs              : ndarray
                           [Optional] List in the same order as w.id_order with
                           the neighborhood to which every observation belongs
@@ -106,6 +268,10 @@ class World():
     max_iter            : int
                           Maximum number of sequential steps to run before
                           giving up on a run
+    rng                 : np.random.RandomState
+                          [Optional] Random state for every draw of the
+                          model, so runs can be reproduced independently of
+                          the global one in `np.random` (used if None)
 
     Methods
     =======
@@ -113,7 +279,9 @@ class World():
                           running by creating the agents and assigning them a
                           random location
     go                  : Run the model until convergence or 10,000
-                          iterations, whatever comes first
+                          iterations, whatever comes first. Takes an
+                          optional observer (e.g. `TickProfiler`) whose
+                          `tick` method is called after every tick
     plot                : generate a figure with a depiction of the final
                           outcome of the world. Requires:
 
@@ -130,7 +298,8 @@ class World():
                             * outfile       : str
                                               [Optional] Path to output file
     '''
-    def __init__(self, pop_size, pct_similar_wanted, prop_groups, w, neighs=None, max_iter=1000):
+    def __init__(self, pop_size, pct_similar_wanted, prop_groups, w, neighs=None, max_iter=1000, \
+            rng=None):
         # Static
         if neighs is not None:
             self.neighs = neighs
@@ -142,6 +311,7 @@ class World():
         self.prop_groups = prop_groups
         self.w = w
         self.max_iter = max_iter
+        self.rng = np.random if rng is None else rng
 
         self.setup()
 
@@ -149,52 +319,53 @@ class World():
         # Dynamic
         self.pct_happy = None
         # Geo
-        self.free_xyids = self.w.id_order
+        self._ids = list(self.w.id_order)
+        self.pool = VacancyPool(len(self._ids), rng=self.rng)
         agent_xyids = self._random_xy_ids(self.pop_size)
         self.agent_xyids = agent_xyids
         # Agents
         agents = []
-        group_map = [np.round(self.pop_size * prop) for prop in self.prop_groups]
-        group_map = [[g] * group_map[g] for g in range(len(group_map))]
-        group_map = [i for sublist in group_map for i in sublist]
-        nlast = self.pop_size - len(group_map)
-        ilast = len(self.prop_groups)
-        group_map = group_map + [ilast] * nlast
+        group_map = self._build_group_map()
         for id, i in enumerate(range(len(self.agent_xyids))):
             agents.append(Agent(id, group_map[i], self.agent_xyids[i]))
         self.agents = agents
         self.group_map = group_map
         # Setup agent topologies
+        self._tindptr, self._tindices = _w2csr(self.w, transpose=True)
         _ = self._update_topo()
         _ = map(self._update_agent_nl, self.agents)
         self.happy_ending = True
         self.pct_happy = sum([1 for a in self.agents if a.happy]) * 1. / self.pop_size
         self.ticks = 0
         
-    def go(self):
+    def go(self, observer=None):
         while not self._all_happy():
             if self.ticks > self.max_iter:
                 #print "No happy ending :-("
                 self.happy_ending = False
                 break
+            t0 = time.time()
             # Find unhappy
-            happy_xyids, unhappy = [], []
-            for a in self.agents:
-                if not a.happy:
-                    unhappy.append(a)
-                else:
-                    happy_xyids.append(a.xyid)
-            self.happy_xyids = happy_xyids
-            self.unhappy = unhappy
-            self.free_xyids = self._which_free(self.happy_xyids)
+            self.unhappy = [a for a in self.agents if not a.happy]
+            t1 = time.time()
+            _ = self._which_free(self.unhappy)
+            t2 = time.time()
             # Assign them different position
+            vacated = [a.xyid for a in self.unhappy]
             _ = self._move_unhappy()
-            self.agent_xyids = [a.xyid for a in self.agents]
-            _ = self._update_topo()
-            _ = map(self._update_agent_nl, self.agents)
+            t3 = time.time()
+            affected = self._update_topo(vacated, \
+                    [a.xyid for a in self.unhappy])
+            t4 = time.time()
+            _ = map(self._update_agent_nl, affected)
 
             self.pct_happy = sum([1 for a in self.agents if a.happy]) * 1. / self.pop_size
+            t5 = time.time()
             self.ticks += 1
+            if observer is not None:
+                observer.tick(self, (t0, t1, t2, t3, t4, t5), \
+                        len(self.unhappy))
+        self.agent_xyids = [a.xyid for a in self.agents]
 
     def plot(self, xys, neighborhoods=None, shpfile=None, outfile=None,
             title=None):
@@ -269,14 +440,16 @@ class World():
             return None
         agents = pd.DataFrame({\
                 'neigh': self.neighs[self.agent_xyids], \
-                'group': [a.group for a in self.agents] \
+                'group': self.group_map \
                 })
         tab = agents.groupby(['neigh', 'group']).size().unstack().fillna(0)
         return tab
 
+    def _build_group_map(self):
+        return _group_map(self.pop_size, self.prop_groups)
+
     def _random_xy_ids(self, r):
-        np.random.shuffle(self.free_xyids)
-        return self.free_xyids[: r]
+        return [self._ids[i] for i in self.pool.draw(r)]
 
     def _update_agent(self, agent):
         around = [self.agents[i].group for i in self.atopo[agent.id]]
@@ -303,12 +476,41 @@ class World():
             agent.happy = False
         agent.similar_nearby = similar_nearby
 
-    def _update_topo(self):
-        atopo = ps.w_subset(self.w, self.agent_xyids, \
-                silent_island_warning=True).neighbors
-        xyid2agent_id = {xyid: agent_id for agent_id, xyid in \
-                enumerate(self.agent_xyids)}
-        self.atopo = {xyid2agent_id[i]: [xyid2agent_id[j] for j in atopo[i]] for i in atopo}# Values are agent order in self.agents!!!
+    def _update_topo(self, vacated=None, filled=None):
+        '''
+        Keep the occupancy index (`xyid2agent_id`) and agent topologies
+        (`atopo`) up to date. If `vacated` and `filled` (pixels left and
+        taken by `self.unhappy`, in the same order) are passed, only the
+        cells involved and the agents that see them are updated, so the cost
+        depends on the number of movers rather than on the size of the world
+
+        Returns
+        -------
+        affected    : list
+                      Agents whose topology might have changed
+        '''
+        if vacated is None:
+            self.xyid2agent_id = {xyid: agent_id for agent_id, xyid in \
+                    enumerate(self.agent_xyids)}
+            self.atopo = {}
+            affected = self.agents
+        else:
+            for xyid in vacated:
+                del self.xyid2agent_id[xyid]
+            for xyid, agent in zip(filled, self.unhappy):
+                self.xyid2agent_id[xyid] = agent.id
+            affected = set([a.id for a in self.unhappy])
+            for xyid in set(vacated).union(filled):
+                i = self.w.id2i[xyid]
+                for j in self._tindices[self._tindptr[i]: self._tindptr[i+1]]:
+                    agent_id = self.xyid2agent_id.get(self._ids[j])
+                    if agent_id is not None:
+                        affected.add(agent_id)
+            affected = [self.agents[i] for i in affected]
+        for agent in affected:
+            self.atopo[agent.id] = [self.xyid2agent_id[j] for j in \
+                    self.w.neighbors[agent.xyid] if j in self.xyid2agent_id]# Values are agent order in self.agents!!!
+        return affected
     
     def _all_happy(self):
         for a in self.agents:
@@ -318,15 +520,627 @@ class World():
                 return False
         return True
 
-    def _which_free(self, taken_xyids):
-        return list(set(self.w.id_order).difference(set(taken_xyids)))
+    def _which_free(self, unhappy):
+        # Pixels of unhappy agents are free to land on again
+        self.pool.release([self.w.id2i[a.xyid] for a in unhappy])
 
     def _move_unhappy(self):
         new_xyids = self._random_xy_ids(len(self.unhappy))
         for new_xyid, unhappy in zip(new_xyids, self.unhappy):
             unhappy.xyid = new_xyid
 
-def bounded_world(r, c, nr, nc):
+class ArrayWorld(World):
+    '''
+    Array-backed controller of model. Same model as `World` (NetLogo
+    happiness rule, unhappy agents relocated at random to any location not
+    taken by a happy agent) but agents are not instantiated: group, location
+    and happiness of every agent are stored in NumPy arrays and each tick is
+    resolved with vectorized operations on the CSR structure of `w`.
+
+    NOTE: pixels are referred to internally by their position in
+    `w.id_order`; `agent_xyids` is translated back to ids in `w`
+    ...
+
+    Arguments
+    =========
+    Same as `World`, plus:
+
+    backend             : str
+                          [Optional. Default='incremental'] Evaluation of
+                          neighbor counts by group. Options are:
+
+                            * 'incremental' : counts are only updated
+                                              around cells vacated and
+                                              filled every tick
+                            * 'sparse'      : counts are recomputed every
+                                              tick in one sparse product of
+                                              the structure of `w` and a
+                                              one-hot occupancy-by-group
+                                              matrix
+
+    Attributes
+    ==========
+    On top of those in `World`:
+
+    groups              : ndarray
+                          Group of every agent
+    locs                : ndarray
+                          Position (in `w.id_order`) of the pixel where every
+                          agent is located
+    happy               : ndarray
+                          Boolean with happiness status of every agent
+    occupant            : ndarray
+                          Agent ID in every pixel (-1 if vacant)
+    counts              : ndarray
+                          Number of neighbors of every pixel in each group,
+                          updated only for the cells vacated and filled
+                          every tick
+    total               : ndarray
+                          Number of occupied neighbors of every pixel
+    '''
+    def __init__(self, pop_size, pct_similar_wanted, prop_groups, w, \
+            neighs=None, max_iter=1000, backend='incremental', rng=None):
+        if backend not in ['incremental', 'sparse']:
+            raise Exception, "`backend` needs to be 'incremental' or 'sparse'"
+        self.backend = backend
+        World.__init__(self, pop_size, pct_similar_wanted, prop_groups, w, \
+                neighs=neighs, max_iter=max_iter, rng=rng)
+
+    def setup(self):
+        # Dynamic
+        self.pct_happy = None
+        # Geo
+        self.xyids = np.asarray(self.w.id_order)
+        self.indptr, self.indices = _w2csr(self.w)
+        self._tindptr, self._tindices = _w2csr(self.w, transpose=True)
+        n = self.xyids.shape[0]
+        if self.backend == 'sparse':
+            self._wsp = sparse.csr_matrix((np.ones(self.indices.shape[0]), \
+                    self.indices, self.indptr), shape=(n, n))
+        # Agents
+        self.group_map = self._build_group_map()
+        self.groups = np.array(self.group_map)
+        self.pool = VacancyPool(n, rng=self.rng)
+        self.locs = self.pool.draw(self.pop_size)
+        self.occupant = -np.ones(n, dtype=int)
+        self.occupant[self.locs] = np.arange(self.pop_size)
+        self.agent_xyids = self.xyids[self.locs]
+        # Setup happiness
+        self.happy = np.zeros(self.pop_size, dtype=bool)
+        self.similar_nearby = np.zeros(self.pop_size, dtype=int)
+        _ = self._update_topo()
+        _ = self._update_happiness()
+        self.happy_ending = True
+        self.pct_happy = self.happy.mean()
+        self.ticks = 0
+
+    def go(self, observer=None):
+        while not self._all_happy():
+            if self.ticks > self.max_iter:
+                self.happy_ending = False
+                break
+            t0 = time.time()
+            # Find unhappy
+            self.unhappy = np.flatnonzero(~self.happy)
+            t1 = time.time()
+            _ = self._which_free(self.unhappy)
+            t2 = time.time()
+            # Assign them different position
+            vacated = self.locs[self.unhappy]
+            _ = self._move_unhappy()
+            t3 = time.time()
+            affected = self._update_topo(vacated, self.locs[self.unhappy])
+            t4 = time.time()
+            _ = self._update_happiness(affected)
+
+            self.pct_happy = self.happy.mean()
+            t5 = time.time()
+            self.ticks += 1
+            if observer is not None:
+                observer.tick(self, (t0, t1, t2, t3, t4, t5), \
+                        self.unhappy.shape[0])
+        self.agent_xyids = self.xyids[self.locs]
+
+    def _update_topo(self, vacated=None, filled=None):
+        '''
+        Keep neighbor counts by group (`counts`, `total`) up to date. If
+        `vacated` and `filled` (pixels left and taken by `self.unhappy`, in
+        the same order) are passed, only pixels that see them are updated
+
+        Returns
+        -------
+        affected    : ndarray
+                      IDs of agents whose neighbor counts might have changed
+        '''
+        n = self.occupant.shape[0]
+        if self.backend == 'sparse':
+            onehot = sparse.csr_matrix((np.ones(self.pop_size), \
+                    (self.locs, self.groups)), shape=(n, self.n_groups))
+            self.counts = (self._wsp * onehot).toarray().astype(np.int32)
+            self.total = self.counts.sum(axis=1)
+            return np.arange(self.pop_size)
+        if vacated is None:
+            pix_group = -np.ones(n, dtype=int)
+            pix_group[self.locs] = self.groups
+            rows = np.repeat(np.arange(n), np.diff(self.indptr))
+            around = pix_group[self.indices]
+            taken = around >= 0
+            counts = np.bincount(rows[taken] * self.n_groups + around[taken], \
+                    minlength=n * self.n_groups)
+            self.counts = counts.reshape((n, self.n_groups)).astype(np.int32)
+            self.total = self.counts.sum(axis=1)
+            return np.arange(self.pop_size)
+        groups = self.groups[self.unhappy]
+        out_nbs, out_k = _gather_csr(self._tindptr, self._tindices, vacated)
+        in_nbs, in_k = _gather_csr(self._tindptr, self._tindices, filled)
+        nbs = np.concatenate((out_nbs, in_nbs))
+        signs = np.concatenate((-np.ones(out_nbs.shape[0]), \
+                np.ones(in_nbs.shape[0])))
+        cells = nbs * self.n_groups + \
+                np.concatenate((groups[out_k], groups[in_k]))
+        _ = _scatter_add(self.total, nbs, signs)
+        touched = _scatter_add(self.counts.reshape(-1), cells, signs)
+        affected = self.occupant[touched // self.n_groups]
+        # Might contain duplicates
+        return np.concatenate((affected[affected >= 0], self.unhappy))
+
+    def _update_happiness(self, agents=None):
+        # Following NetLogo rule
+        if agents is None:
+            agents = np.arange(self.pop_size)
+        locs = self.locs[agents]
+        similar = self.counts[locs, self.groups[agents]]
+        self.happy[agents] = similar >= \
+                (self.pct_similar_wanted * self.total[locs] * 1.)
+        self.similar_nearby[agents] = similar
+
+    def _all_happy(self):
+        return self.happy.all()
+
+    def _which_free(self, unhappy):
+        # Pixels of unhappy agents are free to land on again
+        self.pool.release(self.locs[unhappy])
+
+    def _move_unhappy(self):
+        new_locs = self.pool.draw(len(self.unhappy))
+        self.occupant[self.locs[self.unhappy]] = -1
+        self.locs[self.unhappy] = new_locs
+        self.occupant[new_locs] = self.unhappy
+
+class BlockWorld(ArrayWorld):
+    '''
+    Controller of model specialised for bounded neighborhoods, where every
+    pixel is neighbor of every other pixel in the same neighborhood (as in
+    `ps.block_weights` or `RegionTopology`, used by `bounded_world` and
+    `bounded_world_from_shapefile`). In that topology, happiness only depends
+    on the number of agents of each group in the neighborhood, so the model
+    runs on a (neighborhoods x groups) count table that is updated in O(1)
+    per move, and no list of neighbors is ever built.
+
+    NOTE: the topology is fully determined by `neighs`, so `w` is not used
+    beyond its `id_order` and can be None (see `build_w` in `bounded_world`)
+    ...
+
+    Arguments
+    =========
+    Same as `World`, except:
+
+    w                   : pysal.W/RegionTopology/None
+                          Block weights object for the world or None
+    neighs              : ndarray
+                          List in the same order as w.id_order with the
+                          neighborhood to which every observation belongs to
+                          [Optional if `w` is a RegionTopology]
+
+    Attributes
+    ==========
+    On top of those in `ArrayWorld`:
+
+    blocks              : ndarray
+                          Neighborhood (as position in `block_ids`) of every
+                          pixel
+    block_ids           : ndarray
+                          Neighborhood IDs as in `neighs`
+    counts              : ndarray
+                          Number of agents of every group in each
+                          neighborhood
+    total               : ndarray
+                          Number of agents in each neighborhood
+    '''
+    def __init__(self, pop_size, pct_similar_wanted, prop_groups, w, \
+            neighs=None, max_iter=1000, rng=None):
+        if neighs is None and isinstance(w, RegionTopology):
+            neighs = w.neighs
+        if neighs is None:
+            raise Exception, "BlockWorld requires `neighs`"
+        World.__init__(self, pop_size, pct_similar_wanted, prop_groups, w, \
+                neighs=neighs, max_iter=max_iter, rng=rng)
+
+    def setup(self):
+        # Dynamic
+        self.pct_happy = None
+        # Geo
+        if isinstance(self.w, RegionTopology):
+            self.block_ids, self.blocks = self.w.region_ids, self.w.regions
+        else:
+            self.block_ids, self.blocks = np.unique(self.neighs, \
+                    return_inverse=True)
+        n = self.blocks.shape[0]
+        if self.w is not None:
+            self.xyids = np.asarray(self.w.id_order)
+        else:
+            self.xyids = np.arange(n)
+        # Agents
+        self.group_map = self._build_group_map()
+        self.groups = np.array(self.group_map)
+        self.pool = VacancyPool(n, rng=self.rng)
+        self.locs = self.pool.draw(self.pop_size)
+        self.occupant = -np.ones(n, dtype=int)
+        self.occupant[self.locs] = np.arange(self.pop_size)
+        self.agent_xyids = self.xyids[self.locs]
+        # Setup happiness
+        self.happy = np.zeros(self.pop_size, dtype=bool)
+        self.similar_nearby = np.zeros(self.pop_size, dtype=int)
+        _ = self._update_topo()
+        _ = self._update_happiness()
+        self.happy_ending = True
+        self.pct_happy = self.happy.mean()
+        self.ticks = 0
+
+    def _update_topo(self, vacated=None, filled=None):
+        '''
+        Keep agent counts by neighborhood and group (`counts`, `total`) up to
+        date. If `vacated` and `filled` (pixels left and taken by
+        `self.unhappy`, in the same order) are passed, only the cells of the
+        table involved in the moves are updated
+
+        Returns
+        -------
+        affected    : ndarray
+                      IDs of agents whose neighbor counts might have changed
+        '''
+        n_blocks = self.block_ids.shape[0]
+        if vacated is None:
+            counts = np.bincount(self.blocks[self.locs] * self.n_groups + \
+                    self.groups, minlength=n_blocks * self.n_groups)
+            self.counts = counts.reshape((n_blocks, self.n_groups))
+            self.total = self.counts.sum(axis=1)
+            return np.arange(self.pop_size)
+        groups = self.groups[self.unhappy]
+        moves = np.concatenate((self.blocks[vacated], self.blocks[filled]))
+        signs = np.concatenate((-np.ones(vacated.shape[0]), \
+                np.ones(filled.shape[0])))
+        _ = _scatter_add(self.total, moves, signs)
+        touched = _scatter_add(self.counts.reshape(-1), \
+                moves * self.n_groups + np.concatenate((groups, groups)), \
+                signs)
+        hit = np.zeros(n_blocks, dtype=bool)
+        hit[touched // self.n_groups] = True
+        affected = hit[self.blocks[self.locs]]
+        affected[self.unhappy] = True
+        return np.flatnonzero(affected)
+
+    def _update_happiness(self, agents=None):
+        # Following NetLogo rule (agents are not neighbors of themselves)
+        if agents is None:
+            agents = np.arange(self.pop_size)
+        blocks = self.blocks[self.locs[agents]]
+        similar = self.counts[blocks, self.groups[agents]] - 1
+        self.happy[agents] = similar >= \
+                (self.pct_similar_wanted * (self.total[blocks] - 1) * 1.)
+        self.similar_nearby[agents] = similar
+
+class LatticeWorld(World):
+    '''
+    Controller of model specialised for regular lattices with a queen (Moore)
+    neighborhood, as in `ps.lat2W(r, c, rook=False)`. The world is a 2D
+    int8 grid with the group of the agent in every pixel (-1 if vacant);
+    every tick, similar and total neighbors are counted with a 3x3 stencil
+    and unhappy agents are relocated in place on the grid. Same rule as in
+    `World` (NetLogo).
+
+    If numba is available, every tick runs in a single compiled kernel;
+    otherwise, a vectorized NumPy version is used.
+
+    NOTE: pixel IDs are `row * c + col`, as in `ps.lat2W` and in the `xys`
+    created with `np.indices`
+    ...
+
+    Arguments
+    =========
+    Same as `World`, except:
+
+    shape               : tuple
+                          Number of rows and columns of pixels (replaces `w`)
+    jit                 : Boolean
+                          [Optional. Default=True] Switch to use the numba
+                          kernel when numba is available
+
+    Attributes
+    ==========
+    grid                : ndarray
+                          2D array with the group of the agent in every pixel
+                          (-1 if vacant)
+    '''
+    def __init__(self, pop_size, pct_similar_wanted, prop_groups, shape, \
+            neighs=None, max_iter=1000, jit=True, rng=None):
+        self.shape = shape
+        self.jit = jit and (njit is not None)
+        World.__init__(self, pop_size, pct_similar_wanted, prop_groups, None, \
+                neighs=neighs, max_iter=max_iter, rng=rng)
+
+    def setup(self):
+        # Dynamic
+        self.pct_happy = None
+        # Agents
+        self.group_map = self._build_group_map()
+        locs = self.rng.permutation(self.shape[0] * self.shape[1])
+        self.grid = -np.ones(self.shape, dtype=np.int8)
+        self.grid.flat[locs[: self.pop_size]] = self.group_map
+        if self.jit:
+            _seed_jit(self.rng.randint(2**31 - 1))
+        self._update_agent_xyids()
+        n_unhappy = self._tick(False)
+        self.happy_ending = True
+        self.pct_happy = 1. - n_unhappy * 1. / self.pop_size
+        self.ticks = 0
+
+    def go(self, observer=None):
+        pending = None
+        while True:
+            move = self.ticks <= self.max_iter
+            t0 = time.time()
+            n_unhappy = self._tick(move)
+            t1 = time.time()
+            self.pct_happy = 1. - n_unhappy * 1. / self.pop_size
+            # The kernel counts unhappy agents before moving them, so the
+            # share happy after a tick is only known on the next call
+            if pending is not None:
+                observer.tick(self, *pending)
+                pending = None
+            if n_unhappy == 0:
+                break
+            if not move:
+                self.happy_ending = False
+                break
+            self.ticks += 1
+            if observer is not None:
+                pending = ((t0, t0, t0, t1, t1, t1), n_unhappy)
+        self._update_agent_xyids()
+
+    def _tick(self, move):
+        '''
+        Evaluate happiness on the current grid and, if `move`, relocate
+        unhappy agents. Returns the number of unhappy agents found
+        '''
+        if self.jit:
+            return _lattice_tick_jit(self.grid, self.pct_similar_wanted, move)
+        return _lattice_tick(self.grid, self.pct_similar_wanted, move, \
+                rng=self.rng)
+
+    def _update_agent_xyids(self):
+        self.agent_xyids = np.flatnonzero(self.grid >= 0)
+        self.group_map = list(self.grid.flat[self.agent_xyids])
+
+class BatchWorld():
+    '''
+    Controller of `reps` independent replications of the model, stacked
+    along a leading array axis and advanced together with vectorized
+    operations. Every replication follows the same rules as `World`
+    (NetLogo happiness rule, unhappy agents relocated at random to any
+    location not taken by a happy agent); replications that converged or
+    went over `max_iter` are masked out and stop moving.
+
+    Unhappy agents are relocated drawing from one `VacancyPool` per
+    replication. If `w` is passed, neighbor counts for all active
+    replications are obtained in one sparse product of `w` and a (pixels x reps * groups)
+    one-hot occupancy matrix. If `w` is None (or a RegionTopology), `neighs`
+    is taken as bounded neighborhoods (as in `BlockWorld`) and only (reps x
+    neighborhoods x groups) counts are kept.
+
+    NOTE: dense (pixels x reps x groups) counts are built every tick when
+    `w` is passed, so memory grows with `reps`
+    ...
+
+    Arguments
+    =========
+    reps                : int
+                          Number of replications
+    pop_size            : int
+                          Number of agents to generate in each replication
+    pct_similar_wanted  : float
+                          Proportion in [0, 1] of neighbors that need to be
+                          the same for an agent to be happy
+    pop_groups          : list
+                          List with proportions of the population in each
+                          group, except for the last one, which is calculated
+                          as a residual
+    w                   : pysal.W/RegionTopology/None
+                          Spatial weights object for the world or None for
+                          bounded neighborhoods given by `neighs`
+    neighs              : ndarray
+                          [Optional if `w` is passed] List in the same order
+                          as w.id_order with the neighborhood to which every
+                          observation belongs to
+    max_iter            : int
+                          Maximum number of sequential steps to run before
+                          giving up on a run
+    rngs                : list
+                          [Optional] np.random.RandomState for every
+                          replication (all draws of a replication come from
+                          its own, so it does not depend on the rest of the
+                          batch). If None, the global one in `np.random`
+
+    Attributes
+    ==========
+    locs                : ndarray
+                          (reps x pop_size) position of the pixel where every
+                          agent is located
+    occupant            : ndarray
+                          (reps x pixels) agent ID in every pixel (-1 if
+                          vacant)
+    happy               : ndarray
+                          (reps x pop_size) happiness status of every agent
+    ticks               : ndarray
+                          Number of ticks run by every replication
+    happy_ending        : ndarray
+                          Convergence status of every replication
+    pct_happy           : ndarray
+                          Share of happy agents in every replication
+    pools               : list
+                          `VacancyPool` of every replication
+
+    Methods
+    =======
+    setup               : (run on init by default) Prepare the world to start
+                          running by creating the agents and assigning them a
+                          random location in every replication
+    go                  : Run every replication until convergence or
+                          `max_iter` iterations, whatever comes first
+    export              : Encode one replication into tabular form (as in
+                          `World.export`)
+    '''
+    def __init__(self, reps, pop_size, pct_similar_wanted, prop_groups, w, \
+            neighs=None, max_iter=1000, rngs=None):
+        if w is None and neighs is None:
+            raise Exception, "BatchWorld requires either `w` or `neighs`"
+        if neighs is None and isinstance(w, RegionTopology):
+            neighs = w.neighs
+        self.neighs = neighs
+        self.reps = reps
+        self.pop_size = pop_size
+        self.pct_similar_wanted = pct_similar_wanted
+        self.n_groups = len(prop_groups) + 1
+        self.prop_groups = prop_groups
+        self.w = w
+        self.max_iter = max_iter
+        if rngs is None:
+            rngs = [np.random] * reps
+        self.rngs = rngs
+
+        self.setup()
+
+    def setup(self):
+        # Geo
+        self._wsp = None
+        if isinstance(self.w, RegionTopology):
+            self.block_ids, self.blocks = self.w.region_ids, self.w.regions
+            n = self.blocks.shape[0]
+            self.xyids = np.asarray(self.w.id_order)
+        elif self.w is not None:
+            self.xyids = np.asarray(self.w.id_order)
+            indptr, indices = _w2csr(self.w)
+            n = self.xyids.shape[0]
+            self._wsp = sparse.csr_matrix((np.ones(indices.shape[0]), \
+                    indices, indptr), shape=(n, n))
+        else:
+            self.block_ids, self.blocks = np.unique(self.neighs, \
+                    return_inverse=True)
+            n = self.blocks.shape[0]
+            self.xyids = np.arange(n)
+        # Agents
+        self.group_map = _group_map(self.pop_size, self.prop_groups)
+        self.groups = np.array(self.group_map)
+        self.pools = [VacancyPool(n, rng=rng) for rng in self.rngs]
+        self.locs = np.array([pool.draw(self.pop_size) for pool in self.pools])
+        self.occupant = -np.ones((self.reps, n), dtype=int)
+        self.occupant[np.arange(self.reps)[:, None], self.locs] = \
+                np.arange(self.pop_size)
+        self.agent_xyids = self.xyids[self.locs]
+        # Setup happiness
+        self.happy = np.zeros((self.reps, self.pop_size), dtype=bool)
+        _ = self._update_happiness(np.arange(self.reps))
+        self.happy_ending = np.ones(self.reps, dtype=bool)
+        self.pct_happy = self.happy.mean(axis=1)
+        self.ticks = np.zeros(self.reps, dtype=int)
+
+    def go(self):
+        while True:
+            done = self.happy.all(axis=1)
+            gave_up = ~done & (self.ticks > self.max_iter)
+            self.happy_ending[gave_up] = False
+            reps = np.flatnonzero(~done & ~gave_up)
+            if reps.shape[0] == 0:
+                break
+            _ = self._move_unhappy(reps)
+            _ = self._update_happiness(reps)
+            self.pct_happy[reps] = self.happy[reps].mean(axis=1)
+            self.ticks[reps] += 1
+        self.agent_xyids = self.xyids[self.locs]
+
+    def export(self, rep):
+        '''
+        Encode replication `rep` into tabular form
+        ...
+
+        Returns
+        -------
+        tab     : DataFrame
+                  Frequency table with rows indexed on neighborhood and
+                  columns on group
+        '''
+        if self.neighs is None:
+            print ('Neighborhood cardinality of xys not passed. ' \
+                    'Export not completed')
+            return None
+        agents = pd.DataFrame({\
+                'neigh': self.neighs[self.agent_xyids[rep]], \
+                'group': self.group_map \
+                })
+        tab = agents.groupby(['neigh', 'group']).size().unstack().fillna(0)
+        return tab
+
+    def _move_unhappy(self, reps):
+        unhappy = ~self.happy[reps]
+        rows, agents = np.nonzero(unhappy)
+        old = self.locs[reps[rows], agents]
+        bounds = np.concatenate(([0], np.cumsum(unhappy.sum(axis=1))))
+        new = np.zeros(rows.shape[0], dtype=int)
+        for i, rep in enumerate(reps):
+            # Pixels of unhappy agents are free to land on again
+            self.pools[rep].release(old[bounds[i]: bounds[i+1]])
+            new[bounds[i]: bounds[i+1]] = \
+                    self.pools[rep].draw(bounds[i+1] - bounds[i])
+        self.occupant[reps[rows], old] = -1
+        self.locs[reps[rows], agents] = new
+        self.occupant[reps[rows], new] = agents
+
+    def _update_happiness(self, reps):
+        # Following NetLogo rule
+        locs = self.locs[reps]
+        ireps = np.arange(reps.shape[0])[:, None]
+        groups = self.groups[None, :]
+        if self._wsp is not None:
+            n = self.xyids.shape[0]
+            cols = ireps * self.n_groups + groups
+            onehot = sparse.csr_matrix((np.ones(locs.size), \
+                    (locs.ravel(), cols.ravel())), \
+                    shape=(n, reps.shape[0] * self.n_groups))
+            counts = (self._wsp * onehot).toarray()\
+                    .reshape((n, reps.shape[0], self.n_groups))
+            similar = counts[locs, ireps, groups]
+            total = counts.sum(axis=2)[locs, ireps]
+        else:
+            blocks = self.blocks[locs]
+            n_blocks = self.block_ids.shape[0]
+            cells = (ireps * n_blocks + blocks) * self.n_groups + groups
+            counts = np.bincount(cells.ravel(), \
+                    minlength=reps.shape[0] * n_blocks * self.n_groups)\
+                    .reshape((reps.shape[0], n_blocks, self.n_groups))
+            # Agents are not neighbors of themselves
+            similar = counts[ireps, blocks, groups] - 1
+            total = counts.sum(axis=2)[ireps, blocks] - 1
+        self.happy[reps] = similar >= (self.pct_similar_wanted * total * 1.)
+
+# Engines selectable as config['engine'] in `sim_engine_scoop`. 'lattice'
+# takes the (rows, columns) of the grid instead of `w` and runs queen
+# neighbors around every pixel instead of bounded neighborhoods
+engines = {'agents': World, \
+           'array': ArrayWorld, \
+           'block': BlockWorld, \
+           'lattice': LatticeWorld}
+
+def bounded_world(r, c, nr, nc, build_w=True):
     '''
     Create W object for a bounded neighborhood topology based on grids (pixels
     and neighborhoods)
@@ -345,11 +1159,15 @@ def bounded_world(r, c, nr, nc):
               Number of neighborhoods on the Y axis (rows)
     nc      : int
               Number of neighborhoods on the X axis (columns)
+    build_w : Boolean
+              [Optional. Default=True] If False, the (dense within
+              neighborhoods) W is not built and None is returned instead.
+              Useful with `BlockWorld`, which only needs `ns`
 
     Returns
     -------
     W       : pysal.W
-              Weights object
+              Weights object (None if not `build_w`)
     ns      : ndarray
               Cardinalities for every observation to a neighborhood
     xys     : ndarray
@@ -367,10 +1185,13 @@ def bounded_world(r, c, nr, nc):
             world[nrb[i]: nrb[i+1], ncb[j]:ncb[j+1]] = n
             n += 1
     world = world.flatten()
-    w = ps.block_weights(world)
+    w = None
+    if build_w:
+        w = ps.block_weights(world)
     return w, world, np.hstack((x.flatten()[:, None], y.flatten()[:, None]))
 
-def bounded_world_from_shapefile(path, n, n_as=None):
+def bounded_world_from_shapefile(path, n, n_as=None, build_w=True, \
+        pool=None, seed=None, regions=True):
     '''
     Create W object for `n` agents with bounded locations assigned within
     polygons of a shapefile (neighbor if in the same polygon) in proportion to
@@ -387,49 +1208,578 @@ def bounded_world_from_shapefile(path, n, n_as=None):
               [Optional] Sequence with number of of agents to be assigned to
               every neighborhood, in the order of the dbf accompaigning the
               shapefile. If not provided, proportions are based on area.
+    build_w : Boolean
+              [Optional. Default=True] If False, the topology is not built
+              and None is returned instead (`BlockWorld` only needs `ns`)
+    pool    : object
+              [Optional. Default=None] Pool to spread polygons over (any
+              object with a `map` method, such as a `multiprocessing.Pool`
+              or a `sim_engine_scoop.Executor`), left open for the caller
+              to reuse. If None, polygons are processed one after the other
+    seed    : int
+              [Optional. Default=None] Seed for the location of points.
+              Every polygon draws from its own stream derived from it, so
+              results do not depend on `pool`. If None, drawn from the
+              global state in `np.random`
+    regions : Boolean
+              [Optional. Default=True] If False, a pysal.W is returned
+              instead of a RegionTopology, as in earlier versions
+              (`ps.regime_weights`, quadratic on polygon sizes), e.g. to
+              run the world with `World` or `ArrayWorld`
 
     Returns
     -------
-    W       : pysal.W
-              Weights object
+    W       : RegionTopology/pysal.W
+              Topology of the world, stored by region instead of as
+              pairwise links unless `regions` is False (None if not
+              `build_w`)
     ns      : ndarray
               Cardinalities for every observation to a neighborhood
     xys     : ndarray
               Nx2 array with coordinates of agents (randomly within polygons)
     '''
-    if not n_as:
+    if n_as is None:
         shp = ps.open(path)
         n_shares = np.array([p.area for p in shp])
         shp.close()
         n_shares = n_shares / n_shares.sum()
         n_as = np.round(n * n_shares).astype(int)
         n_as[-1] = n - n_as[:-1].sum() # Hack to get proportions to sum to n
-    xys = np.zeros((n, 2), dtype=int)
     shp = ps.open(path)
     polys = list(shp)
     shp.close()
-    parss = [(n_a, poly) for n_a, poly in zip(n_as, polys)]
-    pool = mp.Pool(mp.cpu_count())
-    xys = pool.map(_random_pts_in_poly, parss)
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    seeds = rng.randint(2**31 - 1, size=len(polys))
+    parss = zip(n_as, polys, seeds)
+    if pool is None:
+        xys = map(_random_pts_in_poly, parss)
+    else:
+        xys = pool.map(_random_pts_in_poly, parss)
     xys = np.concatenate(xys)
     ns = np.concatenate([np.array([neigh]*nn) for neigh, nn in enumerate(n_as)])
-    w = ps.regime_weights(ns)
+    w = None
+    if build_w and regions:
+        w = RegionTopology(ns, xys=xys)
+    elif build_w:
+        w = ps.regime_weights(ns)
     return w, ns, xys
 
+class Topology():
+    '''
+    Lightweight replacement for a pysal.W, holding the topology of the world
+    as flat CSR arrays (plus neighborhoods and coordinates of pixels), so it
+    can be written to disk once and memory-mapped read-only by every worker
+    (see `save_topology` and `load_topology`). It can be passed as `w` to
+    any engine. IDs are positional (0 to n-1).
+    ...
+
+    Arguments
+    =========
+    indptr      : ndarray
+                  CSR row pointers
+    indices     : ndarray
+                  CSR column indices (neighbors of every pixel)
+    neighs      : ndarray
+                  [Optional] Neighborhood to which every pixel belongs to
+    xys         : ndarray
+                  [Optional] Nx2 array with coordinates of pixels
+    tindptr     : ndarray
+                  [Optional] CSR row pointers of the transposed topology.
+                  If not passed, the topology is assumed symmetric
+    tindices    : ndarray
+                  [Optional] CSR column indices of the transposed topology
+
+    Attributes
+    ==========
+    n           : int
+                  Number of pixels
+    id_order    : ndarray
+                  IDs of pixels
+    neighbors   : object
+                  Neighbors of every pixel, indexed as `w.neighbors`
+    id2i        : dict
+                  Position of every ID (built on first use)
+    sparse      : scipy.sparse.csr_matrix
+                  Binary matrix of the topology (built on first use)
+    '''
+    def __init__(self, indptr, indices, neighs=None, xys=None, \
+            tindptr=None, tindices=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.neighs = neighs
+        self.xys = xys
+        if tindptr is None:
+            tindptr, tindices = indptr, indices
+        self.tindptr = tindptr
+        self.tindices = tindices
+        self.n = indptr.shape[0] - 1
+        self.id_order = np.arange(self.n)
+        self.neighbors = _CSRRows(indptr, indices)
+        self._id2i = None
+        self._sparse = None
+
+    @property
+    def id2i(self):
+        if self._id2i is None:
+            self._id2i = {i: i for i in range(self.n)}
+        return self._id2i
+
+    @property
+    def sparse(self):
+        if self._sparse is None:
+            self._sparse = sparse.csr_matrix((np.ones(self.indices.shape[0]), \
+                    self.indices, self.indptr), shape=(self.n, self.n))
+        return self._sparse
+
+class _CSRRows():
+    '''
+    Read-only view of the rows of a CSR structure as lists
+    '''
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, i):
+        return self.indices[self.indptr[i]: self.indptr[i+1]].tolist()
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+class RegionTopology():
+    '''
+    Topology where every pixel is neighbor of every other pixel in the same
+    region (as in `ps.regime_weights`), stored in linear memory as the
+    region of every pixel plus the list of members of every region, instead
+    of every pairwise link (a region with 5,000 pixels would otherwise take
+    25 million entries). Neighbors are listed from the members of the region
+    on request. It can be passed as `w` to `BlockWorld` and `BatchWorld`,
+    which only use the regions. `World` and `ArrayWorld` need pairwise
+    links and refuse it rather than expanding it behind the caller's back;
+    `Topology(*w.csr())` builds them explicitly, in memory quadratic on
+    region sizes. IDs are positional (0 to n-1).
+    ...
+
+    Arguments
+    =========
+    neighs          : ndarray
+                      Neighborhood (region) to which every pixel belongs to
+    xys             : ndarray
+                      [Optional] Nx2 array with coordinates of pixels
+
+    Attributes
+    ==========
+    n               : int
+                      Number of pixels
+    id_order        : ndarray
+                      IDs of pixels
+    region_ids      : ndarray
+                      Region IDs as in `neighs`
+    regions         : ndarray
+                      Region (as position in `region_ids`) of every pixel
+    members         : ndarray
+                      Pixels sorted by region (and ID within region)
+    rindptr         : ndarray
+                      Start of every region in `members` (plus the end of
+                      the last one)
+    sizes           : ndarray
+                      Number of pixels in every region
+    cardinalities   : ndarray
+                      Number of neighbors of every pixel
+    neighbors       : object
+                      Neighbors of every pixel, indexed as `w.neighbors`
+    id2i            : dict
+                      Position of every ID (built on first use)
+    '''
+    def __init__(self, neighs, xys=None):
+        self.neighs = neighs
+        self.xys = xys
+        self.region_ids, self.regions = np.unique(neighs, return_inverse=True)
+        self.n = self.regions.shape[0]
+        self.id_order = np.arange(self.n)
+        self.members = np.argsort(self.regions, kind='mergesort')
+        self.sizes = np.bincount(self.regions, \
+                minlength=self.region_ids.shape[0])
+        self.rindptr = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.cardinalities = self.sizes[self.regions] - 1
+        self.neighbors = _RegionRows(self)
+        self._id2i = None
+
+    @property
+    def id2i(self):
+        if self._id2i is None:
+            self._id2i = {i: i for i in range(self.n)}
+        return self._id2i
+
+    def csr(self):
+        '''
+        Expand the topology into CSR arrays (`indptr`, `indices`), in the
+        same order as `ps.regime_weights`. The topology is symmetric, so
+        they are also those of the transpose
+
+        NOTE: takes memory quadratic on the size of regions
+        '''
+        pixels = self.id_order
+        indices, origin = _gather_csr(self.rindptr, self.members, \
+                self.regions[pixels])
+        indices = indices[indices != pixels[origin]]
+        indptr = np.concatenate(([0], np.cumsum(self.cardinalities)))
+        return indptr, indices
+
+class _RegionRows():
+    '''
+    Read-only view of the neighbors of every pixel in a `RegionTopology`
+    as lists
+    '''
+    def __init__(self, topo):
+        self.topo = topo
+
+    def __getitem__(self, i):
+        r = self.topo.regions[i]
+        members = self.topo.members[self.topo.rindptr[r]: \
+                self.topo.rindptr[r+1]]
+        return members[members != i].tolist()
+
+    def __len__(self):
+        return self.topo.n
+
+def save_topology(folder, w, ns=None, xys=None):
+    '''
+    Write the topology of `w` (and, optionally, neighborhoods and coordinates
+    of pixels) to `folder` as `.npy` files that can be memory-mapped with
+    `load_topology`
+    ...
+
+    Arguments
+    ---------
+    folder  : str
+              Path to folder (created if it does not exist)
+    w       : pysal.W/Topology/RegionTopology
+              Weights object with positional IDs (0 to n-1), as returned by
+              `bounded_world` or `bounded_world_from_shapefile`. For a
+              RegionTopology, only regions (and coordinates) are written
+    ns      : ndarray
+              [Optional] Cardinalities for every observation to a
+              neighborhood
+    xys     : ndarray
+              [Optional] Nx2 array with coordinates of pixels
+
+    Returns
+    -------
+    folder  : str
+              Path to folder
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    if isinstance(w, RegionTopology):
+        # Regions are enough to rebuild it, links are never written
+        arrays = {'neighs': w.neighs}
+        if w.xys is not None:
+            arrays['xys'] = w.xys
+    else:
+        indptr, indices = _w2csr(w)
+        tindptr, tindices = _w2csr(w, transpose=True)
+        arrays = {'indptr': indptr, 'indices': indices}
+        if (tindptr.shape[0] != indptr.shape[0]) or \
+                (tindices.shape[0] != indices.shape[0]) or \
+                (tindptr != indptr).any() or (tindices != indices).any():
+            arrays['tindptr'] = tindptr
+            arrays['tindices'] = tindices
+    if ns is not None:
+        arrays['neighs'] = np.asarray(ns)
+    if xys is not None:
+        arrays['xys'] = np.asarray(xys)
+    for name in arrays:
+        np.save(os.path.join(folder, name + '.npy'), arrays[name])
+    return folder
+
+def load_topology(folder, mmap_mode='r'):
+    '''
+    Load a topology written with `save_topology`. By default, arrays are
+    memory-mapped read-only, so processes loading the same folder share the
+    pages instead of holding their own copy
+    ...
+
+    Arguments
+    ---------
+    folder      : str
+                  Path to folder
+    mmap_mode   : str
+                  [Optional. Default='r'] Passed to `np.load` (None loads
+                  arrays in memory)
+
+    Returns
+    -------
+    topo        : Topology/RegionTopology
+                  Topology object (RegionTopology if only regions were
+                  written)
+    '''
+    arrays = {}
+    for name in ['indptr', 'indices', 'neighs', 'xys', 'tindptr', 'tindices']:
+        path = os.path.join(folder, name + '.npy')
+        if os.path.exists(path):
+            arrays[name] = np.load(path, mmap_mode=mmap_mode)
+    if 'indptr' not in arrays:
+        return RegionTopology(arrays['neighs'], xys=arrays.get('xys'))
+    return Topology(**arrays)
+
+# Bumped whenever what `cache_world_from_shapefile` writes changes (2: by
+# region, see `RegionTopology`)
+_CACHE_VERSION = 2
+
+def cache_world_from_shapefile(path, n, cache, n_as=None, seed=None, \
+        pool=None):
+    '''
+    Content-addressed on-disk cache of `bounded_world_from_shapefile`. The
+    geography is built and written with `save_topology` the first time a
+    combination of shapefile (hashed by content), `n`, `n_as` and `seed` is
+    requested, and every later call (in this or any other process) only
+    returns the folder, ready to be memory-mapped with `load_topology` or
+    passed as 'topology' in the configuration of `god_multi_reps`. The key
+    also includes `_CACHE_VERSION`, so geographies written by an older
+    layout are rebuilt instead of served
+    ...
+
+    Arguments
+    ---------
+    path    : str
+              Link to shapefile containing the geography
+    n       : int
+              Number of pixels to be created within the geography
+    cache   : str
+              Path to the folder holding the cache (created if it does not
+              exist). Every geography is stored in its own subfolder
+    n_as    : array
+              [Optional] Sequence with number of of agents to be assigned to
+              every neighborhood (see `bounded_world_from_shapefile`)
+    seed    : int
+              [Optional. Default=None] Seed for the location of points. If
+              None, the first geography cached for the rest of the key is
+              reused
+    pool    : object
+              [Optional. Default=None] Pool to spread polygons over when
+              the geography is built (see `bounded_world_from_shapefile`)
+
+    Returns
+    -------
+    folder  : str
+              Path to the folder with the geography
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fo:
+        for block in iter(lambda: fo.read(2**20), ''):
+            sha.update(block)
+    if n_as is not None:
+        n_as = [int(n_a) for n_a in n_as]
+    key = json.dumps({'shp': sha.hexdigest(), 'n': int(n), 'n_as': n_as, \
+            'seed': seed, 'version': _CACHE_VERSION}, sort_keys=True)
+    folder = os.path.join(cache, hashlib.sha256(key).hexdigest()[:16])
+    if os.path.exists(folder):
+        return folder
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    w, ns, xys = bounded_world_from_shapefile(path, n, n_as=n_as, \
+            pool=pool, seed=seed)
+    # Written aside and renamed in place, so concurrent builders never see
+    # a half-written folder (the first one to finish wins)
+    tmp = tempfile.mkdtemp(dir=cache)
+    save_topology(tmp, w, ns=ns, xys=xys)
+    with open(os.path.join(tmp, 'key.json'), 'w') as fo:
+        fo.write(key)
+    try:
+        os.rename(tmp, folder)
+    except OSError:
+        shutil.rmtree(tmp)
+    return folder
+
+def _group_map(pop_size, prop_groups):
+    '''
+    Group of every agent, with groups sized after `prop_groups` (the last
+    one as a residual)
+    '''
+    group_map = [int(np.round(pop_size * prop)) for prop in prop_groups]
+    group_map = [[g] * group_map[g] for g in range(len(group_map))]
+    group_map = [i for sublist in group_map for i in sublist]
+    nlast = pop_size - len(group_map)
+    ilast = len(prop_groups)
+    return group_map + [ilast] * nlast
+
+def _w2csr(w, transpose=False):
+    '''
+    Pull the CSR structure (`indptr`, `indices`) out of a W, in the order of
+    `w.id_order`. If `transpose`, row `i` lists the observations that have
+    `i` as a neighbor
+    '''
+    if isinstance(w, Topology):
+        if transpose:
+            return w.tindptr, w.tindices
+        return w.indptr, w.indices
+    if isinstance(w, RegionTopology):
+        raise Exception, "RegionTopology is not expanded into pairwise "\
+                "links: run it with BlockWorld (engine='block') or "\
+                "BatchWorld, or pass Topology(*w.csr()) explicitly"
+    sp = w.sparse
+    if transpose:
+        sp = sp.T
+    sp = sp.tocsr()
+    return sp.indptr, sp.indices
+
+def _gather_csr(indptr, indices, rows):
+    '''
+    Vectorized lookup of the neighbors of `rows` in a CSR structure
+
+    Returns
+    -------
+    neighbors   : ndarray
+                  Concatenated neighbors of every element in `rows`
+    origin      : ndarray
+                  Position in `rows` of the element each neighbor belongs to
+    '''
+    starts = indptr[rows]
+    lens = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+    neighbors = indices[offsets + np.arange(lens.sum())]
+    return neighbors, np.repeat(np.arange(len(rows)), lens)
+
+def _scatter_add(a, idx, vals):
+    '''
+    Unbuffered in-place `a[idx] += vals` on a 1-D array (repeated indices
+    accumulate), same as `np.add.at` but much faster. Large batches are
+    accumulated densely, small ones only over the unique indices
+
+    Returns
+    -------
+    uidx    : ndarray
+              Sorted indices in `a` whose value has changed
+    '''
+    if idx.shape[0] * 8 > a.shape[0]:
+        delta = np.bincount(idx, weights=vals, minlength=a.shape[0])
+        uidx = np.flatnonzero(delta)
+        delta = delta[uidx]
+    else:
+        uidx, inv = np.unique(idx, return_inverse=True)
+        delta = np.bincount(inv, weights=vals)
+        changed = delta != 0
+        uidx, delta = uidx[changed], delta[changed]
+    a[uidx] += delta.astype(a.dtype)
+    return uidx
+
+def _lattice_tick(grid, pct_similar_wanted, move, rng=np.random):
+    '''
+    Vectorized tick of `LatticeWorld`: find agents unhappy on `grid` (Moore
+    neighborhood, NetLogo rule) and, if `move`, relocate them in place to
+    random cells among those vacant or left by unhappy agents (drawn from
+    `rng`)
+
+    Returns
+    -------
+    n_unhappy   : int
+                  Number of unhappy agents found
+    '''
+    r, c = grid.shape
+    padded = -np.ones((r + 2, c + 2), dtype=grid.dtype)
+    padded[1: -1, 1: -1] = grid
+    total = np.zeros((r, c), dtype=np.int16)
+    similar = np.zeros((r, c), dtype=np.int16)
+    for i in range(3):
+        for j in range(3):
+            if i == 1 and j == 1:
+                continue
+            around = padded[i: i + r, j: j + c]
+            total += around >= 0
+            similar += around == grid
+    unhappy = (grid >= 0) & (similar < pct_similar_wanted * total * 1.)
+    unhappy = np.flatnonzero(unhappy)
+    if move and unhappy.shape[0]:
+        flat = grid.reshape(-1)
+        movers = flat[unhappy]
+        flat[unhappy] = -1
+        free = np.flatnonzero(flat < 0)
+        flat[rng.permutation(free)[: movers.shape[0]]] = movers
+    return unhappy.shape[0]
+
+def _lattice_tick_loops(grid, pct_similar_wanted, move):
+    '''
+    Same as `_lattice_tick` but written with explicit loops, to be compiled
+    with numba (see `_lattice_tick_jit`)
+    '''
+    r, c = grid.shape
+    free = np.empty(r * c, dtype=np.int64)
+    movers = np.empty(r * c, dtype=grid.dtype)
+    n_free = 0
+    n_unhappy = 0
+    for i in range(r):
+        for j in range(c):
+            g = grid[i, j]
+            if g < 0:
+                free[n_free] = i * c + j
+                n_free += 1
+                continue
+            total = 0
+            similar = 0
+            for ni in range(max(i - 1, 0), min(i + 2, r)):
+                for nj in range(max(j - 1, 0), min(j + 2, c)):
+                    if ni == i and nj == j:
+                        continue
+                    h = grid[ni, nj]
+                    if h >= 0:
+                        total += 1
+                        if h == g:
+                            similar += 1
+            if similar < pct_similar_wanted * total * 1.:
+                free[n_free] = i * c + j
+                n_free += 1
+                movers[n_unhappy] = g
+                n_unhappy += 1
+    if move and n_unhappy:
+        for k in range(n_free):
+            grid[free[k] // c, free[k] % c] = -1
+        # Partial Fisher-Yates over free cells
+        for k in range(n_unhappy):
+            x = np.random.randint(k, n_free)
+            free[k], free[x] = free[x], free[k]
+            grid[free[k] // c, free[k] % c] = movers[k]
+    return n_unhappy
+
+def _seed(seed):
+    np.random.seed(seed)
+
+if njit is not None:
+    _lattice_tick_jit = njit(cache=True)(_lattice_tick_loops)
+    # numba keeps its own random state, seeded from the world's in `setup`
+    _seed_jit = njit(_seed)
+
 def _random_pts_in_poly(pars):
     '''
-    Generate `n` random points inside a given `polygon`
+    Generate `n` random points inside a given `polygon`, seeding the draws
+    with `seed`. Candidates are drawn in blocks over the bounding box
+    (oversampled by the ratio of bounding box to polygon area) and tested
+    at once with `matplotlib.path.Path.contains_points`
     '''
-    n_pts, poly = pars
+    n_pts, poly, seed = pars
+    if n_pts == 0:
+        return np.zeros((0, 2))
+    if not poly.area > 0:
+        raise Exception, "Cannot place %i pixels in a polygon with no "\
+                "area"%n_pts
+    rng = np.random.RandomState(seed)
     bbox = poly.bounding_box
-    xys = np.zeros((n_pts, 2))
-    for i in np.arange(xys.shape[0]):
-        in_poly = 0
-        while not in_poly:
-            x = np.random.uniform(low=bbox.left, high=bbox.right, size=1)[0]
-            y = np.random.uniform(low=bbox.lower, high=bbox.upper, size=1)[0]
-            in_poly = poly.contains_point((x, y))
-        xys[i] = (x, y)
+    parts = [Path(np.asarray(part)) for part in poly.parts]
+    holes = [Path(np.asarray(hole)) for hole in poly.holes if hole]
+    ratio = (bbox.right - bbox.left) * (bbox.upper - bbox.lower) / poly.area
+    xys = np.zeros((0, 2))
+    while xys.shape[0] < n_pts:
+        left = n_pts - xys.shape[0]
+        # Capped so slivers in large bounding boxes draw in several blocks
+        k = int(min(np.ceil(left * ratio * 1.2), 2**20)) + 8
+        pts = np.column_stack(( \
+                rng.uniform(low=bbox.left, high=bbox.right, size=k), \
+                rng.uniform(low=bbox.lower, high=bbox.upper, size=k)))
+        inside = np.zeros(k, dtype=bool)
+        for part in parts:
+            inside |= part.contains_points(pts)
+        for hole in holes:
+            inside &= ~hole.contains_points(pts)
+        xys = np.concatenate((xys, pts[inside][: left]))
     return xys
 
 if __name__ == '__main__':
@@ -450,26 +1800,19 @@ if __name__ == '__main__':
     shp = '../../data/adam/adam_projected.shp'
     n_pix = world_dims[0] * world_dims[1]
     ti = time.time()
-    w, ns, xys = bounded_world_from_shapefile(link, n_pix)
+    folder = cache_world_from_shapefile(shp, n_pix, '../../data/adam/cache', \
+            seed=1234)
+    w = load_topology(folder)
+    ns, xys = w.neighs, w.xys
     tf = time.time()
-    fo = ps.open(link.replace('.shp', '_random_pts.gal'), 'w')
-    fo.write(w)
-    fo.close()
-    import pandas as pd
-    db = pd.DataFrame({'x': xys[:, 0], 'y': xys[:, 1], 'ns': ns})
-    db.to_csv(link.replace('.shp', '_xys_ns.csv'), index=False)
-    print "Time to create the geography: %.2f seconds"%(tf-ti)
-    w = ps.open(shp.replace('.shp', '_random_pts.gal')).read()
-    db = pd.read_csv(shp.replace('.shp', '_xys_ns.csv'))
-    ns = db['ns'].values
-    xys = db[['x', 'y']].values
+    print "Time to create/load the geography: %.2f seconds"%(tf-ti)
     '''
 
     pop_size = int((world_dims[0] * world_dims[1]) * 0.75)
     pct_similar_wanted = 0.19
     prop_groups = [0.2]
     t0 = time.time()
-    world = World(pop_size, pct_similar_wanted, prop_groups, w, ns)
+    world = BlockWorld(pop_size, pct_similar_wanted, prop_groups, w, ns)
     world.go()
     t1 = time.time()
     print "Total time: %.2f minutes"%((t1-t0) / 60.)
@@ -46,30 +46,57 @@ NOTE: multithreaded version run from the command line as
 
     -n for number of workers to deploy
 
+Alternatively, pass `executor=Executor('processes', workers=3)` to
+`god_multi_reps` to run on a local pool of processes without the scoop
+launcher (see `Executor` for other backends).
+
 '''
 
-import os, time, copy, struct, sys
+import os, time, copy, struct, sys, hashlib, inspect
 import numpy as np
 import pandas as pd
 import pysal as ps
 import multiprocessing as mp
-from scoop import futures
+from multiprocessing.pool import ThreadPool
 from pysal.inequality import _indices as I
-from schelling import World, bounded_world
+import indices as V
+from schelling import engines, BatchWorld, TickProfiler, bounded_world, \
+        save_topology, load_topology
+from sim_io import ResultSink, index_output, group_columns, \
+        converged, META_COLUMNS
 
-def god_multi_reps(taus, prop_groupsS, config, multi=True, max_iter=1000):
+def god_multi_reps(taus, prop_groupsS, config, multi=True, max_iter=1000, \
+        batch=None, executor=None, window=None, adaptive=None, sink=None, \
+        checkpoint=None, profile=None):
     '''
     Main controller for a grid simulation where multi-core processing is spanned at
     the different replications performed for every World
     ...
 
+    The whole sweep (every combination of proportions, tau and replication)
+    is submitted to `executor` as a single queue of tasks, in order, keeping
+    at most `window` of them in flight so workers do not wait for a tau to
+    finish before starting the next one. Once every replication for a tau
+    has finished without any of them converging, higher taus for the same
+    proportions are pruned: their pending tasks are cancelled (or ignored if
+    the backend cannot cancel) and dropped from the output.
+
+    If `adaptive` is passed, every (proportions, tau) cell also stops
+    issuing replications once further ones would add little information
+    (see `_settled`), and the number of replications used for each cell is
+    recorded in the 'reps' column of the output.
+
     Arguments
     ---------
     tau                 : float
                           Values of taus to be evaluated
     config              : dict
                           Set of static parameters that determine the world to be
-                          created
+                          created. Its 'seed' (drawn at random and printed
+                          if not present) is the master seed every
+                          replication derives its own from (see `rep_seed`).
+                          If it has 'indices', workers return indices
+                          instead of counts (see `run_rep_multi`)
     prop_groups         : list
                           Proportions of population for each n-1 groups
     multi               : Boolean
@@ -78,52 +105,400 @@ def god_multi_reps(taus, prop_groupsS, config, multi=True, max_iter=1000):
     max_iter            : int
                           Maximum number of sequential steps to run before
                           giving up on a Schelling run
+    batch               : int
+                          [Optional. Default=None] If passed, replications
+                          are run in `BatchWorld` blocks of (at most) this
+                          size, each block being a single task
+    executor            : Executor
+                          [Optional. Default=None] Backend to run tasks on.
+                          If None, scoop is used when `multi` is True and
+                          tasks run serially otherwise
+    window              : int
+                          [Optional. Default=None] Maximum number of tasks
+                          in flight. If None, twice the number of workers of
+                          `executor`. Larger windows keep workers busier at
+                          the cost of more runs wasted on pruned taus
+    adaptive            : dict
+                          [Optional. Default=None] If passed, stop the
+                          replications of a cell early. Keys (all optional):
+
+                            * 'min_reps': replications to run before
+                              checking (Default=10)
+                            * 'tol': maximum half-width of the confidence
+                              interval of the convergence rate
+                              (Default=0.1)
+                            * 'rel_tol': maximum half-width of the
+                              confidence interval of the mean of every
+                              global index (`global_diversity`) over
+                              converged replications, relative to the mean
+                              (Default=0.05)
+                            * 'z': critical value of the intervals
+                              (Default=1.96)
+    sink                : ResultSink
+                          [Optional. Default=None] If passed, the output of
+                          every cell is appended to `sink` as soon as it
+                          finishes instead of being kept in memory
+    checkpoint          : Checkpoint
+                          [Optional. Default=None] If passed, every task
+                          run is recorded in `checkpoint` and those already
+                          recorded (e.g. by a run that crashed) are not run
+                          again
+    profile             : dict
+                          [Optional. Default=None] If passed, every
+                          replication is run with a `TickProfiler` and its
+                          trace (seconds by stage, movers and share happy
+                          per tick) is stored in `profile` keyed on
+                          (prop_mix, tau, rep_id). Use `pd.concat(profile)`
+                          to stack them. Not collected for replications
+                          run in `batch` or loaded from `checkpoint`
 
     Returns
     -------
-    simout              : DataFrame
-                          Output table
+    simout              : DataFrame/ResultSink
+                          Output table (`sink` if passed, use its `read`
+                          method to load it)
     '''
-    out = []
-    for prop_groups in prop_groupsS:
-        props = prop_groups + [1.-sum(prop_groups)]
-        prop_mix = '_'.join(map(str, props))
-        any_good_before = True
-        for tau in taus:
-            if any_good_before:
-                ti = time.time()
-                if multi:
-                    reps = futures.map(run_rep_multi, \
-                            [(id, tau, prop_groups, config, max_iter) \
-                            for id in np.arange(config['replications'])])
-                else:
-                    reps = map(run_rep_multi, \
-                            [(id, tau, prop_groups, config, max_iter) \
-                            for id in np.arange(config['replications'])])
-                reps = pd.concat(reps)
-                reps['tau'] = tau
-                reps['prop_mix'] = prop_mix
-                out.append(reps)
-                tf = time.time()
-                if reps.dropna().shape[0] == 0:
-                    any_good_before = False
-                print "Tau: %f | Proportions: "%tau, prop_groups, \
-                        " finished in %.4f mins."%((tf-ti)/60.)
+    if executor is None:
+        executor = Executor('scoop' if multi else 'serial')
+    if window is None:
+        window = 2 * executor.workers
+    if batch:
+        fun = run_batch_multi
+        ids = np.arange(config['replications'])
+        ids = np.array_split(ids, int(np.ceil(ids.shape[0] * 1. / batch)))
+    else:
+        fun = run_rep_multi
+        ids = np.arange(config['replications'])
+    if config.get('seed') is None:
+        config = copy.copy(config)
+        config['seed'] = _urandom_seed()
+        print "Master seed: %i"%config['seed']
+    if profile is not None:
+        config = copy.copy(config)
+        config['profile'] = True
+    ntaus = len(taus)
+    prop_mixes = map(_prop_mix, prop_groupsS)
+    cells, started, stats = {}, {}, {}
+    tasks, left, ready = [], {}, []
+    for p in range(len(prop_groupsS)):
+        for t in range(ntaus):
+            done = set()
+            if checkpoint is not None:
+                done = checkpoint.completed(prop_mixes[p], taus[t])
+            if done:
+                tab = checkpoint.load(prop_mixes[p], taus[t])
+                cells[(p, t)] = [tab]
+                if adaptive is not None:
+                    stats[(p, t)] = _rep_stats(tab)
+            left[(p, t)] = 0
+            if done and adaptive is not None and \
+                    _settled(stats[(p, t)], **adaptive):
+                ready.append((p, t))
+                continue
+            for id in ids:
+                if batch:
+                    id = np.array([i for i in id if i not in done])
+                    if id.shape[0] == 0:
+                        continue
+                elif id in done:
+                    continue
+                tasks.append((p, t, id))
+                left[(p, t)] += 1
+            if left[(p, t)] == 0:
+                ready.append((p, t))
+    # Index of the first tau with no good replication, by proportions
+    pruned = {}
+    running = []
+    i = 0
+    while i < len(tasks) or running or ready:
+        while i < len(tasks) and len(running) < window:
+            p, t, id = tasks[i]
+            i += 1
+            if t > pruned.get(p, ntaus) or left[(p, t)] <= 0:
+                continue
+            started.setdefault((p, t), time.time())
+            f = executor.submit(fun, \
+                    (id, taus[t], prop_groupsS[p], config, max_iter))
+            running.append((p, t, f))
+        if running and not ready:
+            done = executor.wait([f for p, t, f in running])
+        else:
+            done = []
+        finished = [r for r in running if r[2] in done]
+        running = [r for r in running if r[2] not in done]
+        for p, t, f in finished:
+            if t > pruned.get(p, ntaus) or left[(p, t)] <= 0:
+                continue
+            tab = f.result()
+            if profile is not None:
+                tab, traces = tab
+                for rep_id, trace in traces.iteritems():
+                    profile[(prop_mixes[p], taus[t], rep_id)] = trace
+            if checkpoint is not None:
+                checkpoint.record(tab, prop_mixes[p], taus[t])
+            cells.setdefault((p, t), []).append(tab)
+            left[(p, t)] -= 1
+            if adaptive is not None:
+                stats.setdefault((p, t), []).extend(_rep_stats(tab))
+                if left[(p, t)] > 0 and _settled(stats[(p, t)], **adaptive):
+                    left[(p, t)] = 0
+                    for r in [r for r in running if r[:2] == (p, t)]:
+                        r[2].cancel()
+                        running.remove(r)
+            if left[(p, t)] <= 0:
+                ready.append((p, t))
+        # Wrap up cells with every replication run
+        for p, t in ready:
+            if t > pruned.get(p, ntaus):
+                continue
+            reps = pd.concat(cells[(p, t)])
+            if adaptive is not None:
+                reps['reps'] = len(stats[(p, t)])
+            reps['tau'] = taus[t]
+            reps['prop_mix'] = prop_mixes[p]
+            reps.index.name = 'group'
+            good = converged(reps).any()
+            if sink is None:
+                cells[(p, t)] = reps
             else:
-                pass
-    ##
-    out = pd.concat(out)
-    out.index.name = 'group'
-    out = out.set_index(['tau', 'prop_mix', 'rep_id'], append=True)\
-            .swaplevel(0, 1).swaplevel(1, 2).swaplevel(2, 3)
-    t1 = time.time()
+                # Replace partition in case it was written before a restart
+                sink.drop(prop_mixes[p], taus[t])
+                sink.append(reps)
+                cells[(p, t)] = None
+            if (p, t) in started:
+                print "Tau: %f | Proportions: "%taus[t], prop_groupsS[p], \
+                    " finished in %.4f mins."%((time.time()-started[(p, t)])/60.)
+            if not good and t < pruned.get(p, ntaus):
+                pruned[p] = t
+                for r in [r for r in running if r[0] == p and r[1] > t]:
+                    r[2].cancel()
+                    running.remove(r)
+                if sink is not None:
+                    for t_ in range(t + 1, ntaus):
+                        sink.drop(prop_mixes[p], taus[t_])
+        ready = []
+    if sink is not None:
+        return sink
+    out = [cells[(p, t)] for p in range(len(prop_groupsS)) \
+            for t in range(min(pruned.get(p, ntaus) + 1, ntaus))]
+    return index_output(pd.concat(out).reset_index())
+
+def _rep_stats(tab):
+    '''
+    Convergence and global indices (`global_diversity`) of every
+    replication in the output `tab` of a task. If counts were not kept,
+    indices computed in the worker (averaged over groups) are used instead
+    '''
+    conv = converged(tab)
+    groups = group_columns(tab)
+    others = [col for col in tab.columns if col not in META_COLUMNS + groups]
+    out = []
+    for rep_id, rep in tab.groupby('rep_id'):
+        if not conv[rep_id]:
+            out.append((False, None))
+        elif groups and rep[groups].notnull().all(axis=1).any():
+            out.append((True, \
+                    global_diversity(rep[groups].dropna().astype(float))))
+        else:
+            out.append((True, rep[others].mean()))
     return out
 
+def _settled(stats, min_reps=10, tol=0.1, rel_tol=0.05, z=1.96):
+    '''
+    Decide whether a cell has run enough replications
+    ...
+
+    The convergence rate is bounded with an Agresti-Coull interval (which
+    does not collapse to zero width when no replication converges) and the
+    mean of every global index over converged replications with a normal
+    interval. The cell is settled when, after `min_reps` replications, both
+    are narrower than `tol` and `rel_tol` (relative to the mean),
+    respectively. Index means are only checked if at least two
+    replications converged.
+
+    Arguments
+    ---------
+    stats       : list
+                  Tuples (converged, indices) for every replication, as
+                  returned by `_rep_stats`
+    min_reps    : int
+                  See `god_multi_reps`
+    tol         : float
+                  See `god_multi_reps`
+    rel_tol     : float
+                  See `god_multi_reps`
+    z           : float
+                  See `god_multi_reps`
+
+    Returns
+    -------
+    settled     : Boolean
+                  True if no more replications are needed
+    '''
+    n = len(stats)
+    if n < min_reps:
+        return False
+    good = [ind for conv, ind in stats if conv]
+    n_ = n + z**2
+    p_ = (len(good) + z**2 / 2.) / n_
+    if z * np.sqrt(p_ * (1 - p_) / n_) > tol:
+        return False
+    if len(good) < 2:
+        return True
+    good = pd.DataFrame(good)
+    hw = z * good.std() / np.sqrt(good.shape[0])
+    return (hw <= rel_tol * good.mean().abs()).all()
+
+class Executor():
+    '''
+    Backend on which `god_multi_reps` runs its tasks
+    ...
+
+    Arguments
+    ---------
+    backend             : str/object
+                          [Optional. Default='processes'] One of:
+
+                            * 'serial': tasks run one after the other in
+                              the calling process
+                            * 'threads': pool of threads (only worth it
+                              if the engine releases the GIL)
+                            * 'processes': pool of processes
+                              (`multiprocessing.Pool`)
+                            * 'scoop': `scoop.futures` (run the script
+                              with `python -m scoop`)
+
+                          Alternatively, an object with `submit` and `map`
+                          methods, such as a `concurrent.futures`
+                          `ProcessPoolExecutor`, which is then used as is
+    workers             : int
+                          [Optional. Default=None] Number of threads or
+                          processes in the pool (`mp.cpu_count()` if None).
+                          Ignored by 'serial' and 'scoop', which sets it
+                          from its launcher
+    chunksize           : int
+                          [Optional. Default=1] Number of tasks sent to a
+                          worker at a time in `map`
+
+    Attributes
+    ----------
+    workers             : int
+                          Number of workers (guessed from `mp.cpu_count()`
+                          for 'scoop' unless passed)
+    pool                : object
+                          Underlying pool/module tasks are sent to (None
+                          for 'serial')
+    '''
+    def __init__(self, backend='processes', workers=None, chunksize=1):
+        self.backend = backend
+        self.workers = workers or mp.cpu_count()
+        self.chunksize = chunksize
+        if backend == 'serial':
+            self.pool = None
+            self.workers = 1
+        elif backend == 'threads':
+            self.pool = ThreadPool(self.workers)
+        elif backend == 'processes':
+            self.pool = mp.Pool(self.workers)
+        elif backend == 'scoop':
+            from scoop import futures
+            self.pool = futures
+        elif hasattr(backend, 'submit') and hasattr(backend, 'map'):
+            self.pool = backend
+            self.workers = workers or getattr(backend, '_max_workers', \
+                    self.workers)
+            # Some concurrent.futures backports do not take `chunksize`
+            try:
+                spec = inspect.getargspec(backend.map)
+                self._chunked = 'chunksize' in spec.args or \
+                        spec.keywords is not None
+            except TypeError:
+                self._chunked = False
+        else:
+            raise Exception, "Executor backend '%s' not understood"%backend
+
+    def map(self, fun, tasks):
+        '''
+        Apply `fun` to every element in `tasks` and return the list of
+        results, in the same order
+        '''
+        if self.pool is None:
+            return map(fun, tasks)
+        elif self.backend in ['threads', 'processes']:
+            return self.pool.map(fun, tasks, chunksize=self.chunksize)
+        elif self.backend == 'scoop':
+            return list(self.pool.map(fun, tasks))
+        if self._chunked:
+            return list(self.pool.map(fun, tasks, chunksize=self.chunksize))
+        return list(self.pool.map(fun, tasks))
+
+    def submit(self, fun, task):
+        '''
+        Send `fun(task)` to the backend and return a future with `result`,
+        `done` and `cancel` methods
+        '''
+        if self.pool is None:
+            return _DoneFuture(fun(task))
+        elif self.backend in ['threads', 'processes']:
+            return _AsyncFuture(self.pool.apply_async(fun, (task, )))
+        return self.pool.submit(fun, task)
+
+    def wait(self, fs):
+        '''
+        Block until at least one of the futures in `fs` is done and return
+        the list of those done
+        '''
+        if self.backend == 'scoop':
+            done, not_done = self.pool.wait(fs, \
+                    return_when=self.pool.FIRST_COMPLETED)
+            return list(done)
+        while True:
+            done = [f for f in fs if f.done()]
+            if done:
+                return done
+            time.sleep(0.005)
+
+    def shutdown(self):
+        '''
+        Release the workers of the pool (only for backends created here)
+        '''
+        if self.backend in ['threads', 'processes']:
+            self.pool.close()
+            self.pool.join()
+
+class _DoneFuture():
+    '''
+    Future of a task already run
+    '''
+    def __init__(self, value):
+        self.value = value
+    def result(self):
+        return self.value
+    def done(self):
+        return True
+    def cancel(self):
+        return False
+
+class _AsyncFuture():
+    '''
+    Future interface on top of a `multiprocessing` AsyncResult (which cannot
+    be cancelled)
+    '''
+    def __init__(self, res):
+        self.res = res
+    def result(self):
+        return self.res.get()
+    def done(self):
+        return self.res.ready()
+    def cancel(self):
+        return False
+
 def run_rep_multi(rep_id_tau_prop_groups_config_max_iter):
     '''
     Run replication for a combination of parameters-tau and return final
     pattern. Meant for multi-processing as it involves W creation within the
-    replication to overpass ROD issue in ps.W
+    worker to overpass ROD issue in ps.W (the W is only built once per
+    process, see `get_bounded_world`)
     ...
 
     Arguments
@@ -134,39 +509,255 @@ def run_rep_multi(rep_id_tau_prop_groups_config_max_iter):
                               Replication id to append to output series as name
             tau
             prop_groups
-            config
+            config          : dict
+                              Same as in `god_multi_reps`. If it contains
+                              an 'engine' key, it selects the World engine
+                              from `schelling.engines` ('agents' by default).
+                              'lattice' runs on the grid of pixels ('Yi' by
+                              'Xi') with queen neighbors, and counts are
+                              still reported by neighborhood
+                              If it contains an 'indices' key (list with
+                              'spatial' and/or 'global'), those indices are
+                              computed here and returned instead of counts
+                              (or on top of them, if 'keep_counts' is True).
+                              If 'profile' is True, the run is traced with
+                              a `TickProfiler`
             max_iter
 
     Returns
     -------
     tab                 : DataFrame
                           Frequency table with rows indexed on neighborhood and
-                          columns on group
+                          columns on group, plus the seed of the replication
+                          (see `rep_seed`). If config['indices'] is passed,
+                          rows indexed on group ('g%i') with a column for
+                          every index (global indices are repeated for every
+                          group)
+    traces              : dict
+                          Only if config['profile'] is True, trace of the
+                          run (`TickProfiler.trace`) keyed on `rep_id`
     '''
-    seed = abs(struct.unpack('i',os.urandom(4))[0])
-    np.random.seed(seed)
     # Setup the world
-    t0 = time.time()
     rep_id, tau, prop_groups, config, max_iter = rep_id_tau_prop_groups_config_max_iter
-    w, ns, xys = bounded_world(config['Yi'], config['Xi'], config['Yn'], config['Xn'])
-    pop_size = int(round((1 - config['vacant']) * w.n))
-    world = World(pop_size, tau, prop_groups, w, neighs=ns, max_iter=max_iter)
-    t1 = time.time()
+    seed = rep_seed(config.get('seed'), _prop_mix(prop_groups), tau, rep_id)
+    engine = config.get('engine', 'agents')
+    w, ns, xys = get_bounded_world(config, \
+            build_w=(engine not in ['block', 'lattice']))
+    if engine == 'lattice':
+        if 'topology' in config:
+            raise Exception, "The 'lattice' engine needs a grid of pixels "\
+                    "('Yi', 'Xi'), not a 'topology'"
+        w = (config['Yi'], config['Xi'])
+    pop_size = int(round((1 - config['vacant']) * ns.shape[0]))
+    world = engines[engine](pop_size, tau, prop_groups, w, neighs=ns, \
+            max_iter=max_iter, rng=np.random.RandomState(seed))
     # Model run
-    world.setup()
-    world.go()
+    profiler = TickProfiler() if config.get('profile') else None
+    world.go(observer=profiler)
     tab = world.export()
     # Plumbing out
-    t2 = time.time()
+    tab = _format_tab(tab, rep_id, world.happy_ending, world.ticks, seed, \
+            indices=config.get('indices'), \
+            keep_counts=config.get('keep_counts', False))
+    if profiler is not None:
+        return tab, {rep_id: profiler.trace()}
+    return tab
+
+def run_batch_multi(rep_ids_tau_prop_groups_config_max_iter):
+    '''
+    Run a block of replications for a combination of parameters-tau in a
+    single `BatchWorld` and return their final patterns, in the same format
+    as `run_rep_multi`
+    ...
+
+    Arguments
+    ---------
+    rep_ids_tau_prop_groups_config_max_iter: tuple containing:
+
+            rep_ids         : array
+                              IDs of the replications in the block
+            tau
+            prop_groups
+            config          : dict
+                              Same as in `god_multi_reps`. If
+                              config['engine'] is 'block', replications run
+                              on bounded neighborhoods without building W
+            max_iter
+
+    Returns
+    -------
+    tab                 : DataFrame
+                          Frequency tables of every replication, with rows
+                          indexed on neighborhood and columns on group
+    traces              : dict
+                          Only if config['profile'] is True, empty (runs in
+                          a batch are not traced)
+    '''
+    rep_ids, tau, prop_groups, config, max_iter = rep_ids_tau_prop_groups_config_max_iter
+    master = config.get('seed')
+    if master is None:
+        master = _urandom_seed()
+    seeds = [rep_seed(master, _prop_mix(prop_groups), tau, rep_id) \
+            for rep_id in rep_ids]
+    engine = config.get('engine', 'agents')
+    if engine == 'lattice':
+        raise Exception, "Batches do not run the 'lattice' engine"
+    w, ns, xys = get_bounded_world(config, build_w=(engine != 'block'))
+    pop_size = int(round((1 - config['vacant']) * ns.shape[0]))
+    world = BatchWorld(len(rep_ids), pop_size, tau, prop_groups, w, \
+            neighs=ns, max_iter=max_iter, \
+            rngs=[np.random.RandomState(seed) for seed in seeds])
+    world.go()
+    tabs = [_format_tab(world.export(i), rep_id, world.happy_ending[i], \
+            world.ticks[i], seeds[i], indices=config.get('indices'), \
+            keep_counts=config.get('keep_counts', False)) \
+            for i, rep_id in enumerate(rep_ids)]
+    if config.get('profile'):
+        return pd.concat(tabs), {}
+    return pd.concat(tabs)
+
+def _format_tab(tab, rep_id, happy_ending, ticks, seed, indices=None, \
+        keep_counts=False):
+    '''
+    Label the frequency table of a replication for output, blanking counts
+    if the replication did not converge. If `indices` (list with 'spatial'
+    and/or 'global') is passed, they are computed on the table and returned
+    as rows indexed on group, instead of counts unless `keep_counts`. They
+    are computed (and then blanked) for replications that did not converge
+    too, so every replication has the same columns and their tables can be
+    appended to the same file (see `ResultSink` and `Checkpoint`)
+    '''
     tab = tab.rename(index=lambda i: "n%i"%i, columns=lambda i: "g%i"%i)
+    if indices:
+        inds = pd.DataFrame(index=tab.columns)
+        x = tab.astype(float)
+        if 'spatial' in indices:
+            inds = inds.join(spatial_diversity(x))
+        if 'global' in indices:
+            for name, value in global_diversity(x).iteritems():
+                inds[name] = value
+        tab = pd.concat([tab, inds]) if keep_counts else inds
     tab['rep_id'] = rep_id
-    t3 = time.time()
-    if not world.happy_ending:
+    if not happy_ending:
         for col in tab.columns.drop('rep_id'):
             tab[col] = None
-    tab['ticks'] = world.ticks
+    tab['ticks'] = ticks
+    tab['seed'] = seed
     return tab
 
+def rep_seed(seed, prop_mix, tau, rep_id):
+    '''
+    Seed of a replication, derived from the master seed of the sweep and the
+    cell and ID of the replication, so every replication has its own stream
+    (independent of the process or order in which it runs) and can be run
+    again on its own with `np.random.RandomState(seed)` passed as `rng` to
+    the engine
+    ...
+
+    Arguments
+    ---------
+    seed        : int
+                  Master seed of the sweep (a random one is drawn if None)
+    prop_mix    : str
+                  Proportions of the cell, as in the output
+    tau         : float
+                  Tau of the cell
+    rep_id      : int
+                  ID of the replication
+
+    Returns
+    -------
+    seed        : int
+                  Seed in [0, 2**32)
+    '''
+    if seed is None:
+        seed = _urandom_seed()
+    key = '%i|%s|%r|%i'%(seed, prop_mix, float(tau), rep_id)
+    return int(hashlib.sha256(key).hexdigest()[: 8], 16)
+
+def _urandom_seed():
+    return abs(struct.unpack('i', os.urandom(4))[0])
+
+def _prop_mix(prop_groups):
+    '''
+    Label of a combination of proportions in the output
+    '''
+    return '_'.join(map(str, prop_groups + [1.-sum(prop_groups)]))
+
+def get_bounded_world(config, build_w=True):
+    '''
+    Geometry of the bounded world in `config`, built the first time it is
+    requested in a process and reused by every replication and tau after
+    that (worlds do not modify it)
+    ...
+
+    Arguments
+    ---------
+    config              : dict
+                          Same as in `god_multi_reps`
+    build_w             : Boolean
+                          [Optional. Default=True] If False, None is returned
+                          instead of the W, which is not built if not cached
+
+    Returns
+    -------
+    W                   : pysal.W/Topology
+                          Weights object (None if not `build_w`). If
+                          `config` has a 'topology' folder (see
+                          `share_bounded_world`), a memory-mapped Topology
+    ns                  : ndarray
+                          Cardinalities for every observation to a
+                          neighborhood
+    xys                 : ndarray
+                          Nx2 array with coordinates of pixels
+    '''
+    if 'topology' in config:
+        key = config['topology']
+        if key not in _geometries:
+            topo = load_topology(key)
+            _geometries[key] = (topo, topo.neighs, topo.xys)
+        w, ns, xys = _geometries[key]
+        if not build_w:
+            w = None
+        return w, ns, xys
+    key = (config['Yi'], config['Xi'], config['Yn'], config['Xn'])
+    if key not in _geometries or (build_w and _geometries[key][0] is None):
+        _geometries[key] = bounded_world(config['Yi'], config['Xi'], \
+                config['Yn'], config['Xn'], build_w=build_w)
+    w, ns, xys = _geometries[key]
+    if not build_w:
+        w = None
+    return w, ns, xys
+
+_geometries = {}
+
+def share_bounded_world(config, folder):
+    '''
+    Build the bounded world in `config` once, write it to `folder` and
+    return a copy of `config` pointing to it, so every worker memory-maps
+    the same read-only topology instead of building its own W
+    ...
+
+    Arguments
+    ---------
+    config              : dict
+                          Same as in `god_multi_reps`
+    folder              : str
+                          Path to folder where to write the topology
+
+    Returns
+    -------
+    config              : dict
+                          Copy of `config` with the key 'topology' pointing
+                          to `folder`
+    '''
+    w, ns, xys = bounded_world(config['Yi'], config['Xi'], \
+            config['Yn'], config['Xn'])
+    save_topology(folder, w, ns=ns, xys=xys)
+    config = copy.copy(config)
+    config['topology'] = os.path.abspath(folder)
+    return config
+
 def global_diversity(df, id=None):
     '''
     Calculate all diversity global indices from the output of one replication and
@@ -220,12 +811,12 @@ def spatial_diversity(df, id=None):
               Indices computed
     '''
     indices = [ \
-            I.segregation_gsg, \
-            I.modified_segregation_msg, \
-            I.isolation_isg, \
-            I.gini_gig, \
-            I.ellison_glaeser_egg_pop, \
-            I.maurel_sedillot_msg_pop, \
+            V.segregation_gsg, \
+            V.modified_segregation_msg, \
+            V.isolation_isg, \
+            V.gini_gig, \
+            V.ellison_glaeser_egg_pop, \
+            V.maurel_sedillot_msg_pop, \
             ]
     out = pd.DataFrame({ind.func_name: pd.Series(ind(df.values), index=df.columns) \
             for ind in indices})
@@ -272,8 +863,11 @@ if __name__=='__main__':
             }
 
     t0 = time.time()
-    out = god_multi_reps(taus, prop_groupsS, config, multi=False, max_iter=2000)
+    # Cells are streamed to `schelling_out_maps/` as they finish
+    sink = ResultSink('schelling_out_maps')
+    god_multi_reps(taus, prop_groupsS, config, multi=False, max_iter=2000, \
+            sink=sink)
     t1 = time.time()
     print 'Total time: %.2f seconds'%(t1-t0)
-    out.to_csv('schelling_out_maps.csv')
+    sink.read().to_csv('schelling_out_maps.csv')
 
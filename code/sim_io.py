@@ -0,0 +1,452 @@
+'''
+Storage of simulation output for "How diverse can spatial measures of cultural diversity be? Results from Monte Carlo simulations of an agent-based model", by Dani
+Arribas-Bel, Peter Nijkamp and Jacques Poot
+Author: Dani Arribas-Bel <daniel.arribas.bel@gmail.com>
+...
+
+Copyright (c) 2015, Daniel Arribas-Bel
+
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+
+* The name of Daniel Arribas-Bel may not be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND
+CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF
+USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+---
+
+Sinks where `god_multi_reps` streams results as (proportions, tau) cells
+finish, so memory does not grow with the size of the sweep and partial
+results survive a crash
+
+'''
+
+import os, re, json
+import numpy as np
+import pandas as pd
+
+class ResultSink():
+    '''
+    Append-only store of simulation output, partitioned by proportions and
+    tau. Every partition is written (and the file closed) as soon as its
+    cell finishes, so whatever is on disk can be read at any time
+    ...
+
+    Arguments
+    ---------
+    path        : str
+                  Folder (for 'csv' and 'npy') or file (for 'hdf') to
+                  write to
+    format      : str
+                  [Optional. Default='csv'] 'csv' writes one file per
+                  partition under `path`; 'hdf' writes one table per
+                  partition in an HDF5 file (requires PyTables); 'npy'
+                  writes, for every partition, a dense (rep, neighborhood,
+                  group) tensor of counts as `.npy` (uint16, or uint32 if
+                  counts do not fit) plus a `.json` with labels and
+                  per-replication columns (see `load`). 'npy' partitions
+                  are written once, when their cell finishes: appending
+                  to an existing one raises (`drop` it first)
+
+    Attributes
+    ----------
+    partitions  : list
+                  (prop_mix, tau) of the partitions written
+    '''
+    def __init__(self, path, format='csv'):
+        if format not in ['csv', 'hdf', 'npy']:
+            raise Exception, "Sink format '%s' not understood"%format
+        self.path = path
+        self.format = format
+        if format in ['csv', 'npy'] and not os.path.exists(path):
+            os.makedirs(path)
+        self.partitions = [self._unkey(k) for k in self._keys()]
+
+    def append(self, tab):
+        '''
+        Append output of a cell, with 'tau' and 'prop_mix' columns and index
+        on neighborhood, as built in `god_multi_reps`
+        '''
+        tab = tab.reset_index()
+        tab = tab.rename(columns={tab.columns[0]: 'group'})
+        for (prop_mix, tau), part in tab.groupby(['prop_mix', 'tau']):
+            key = self._key(prop_mix, tau)
+            if self.format == 'csv':
+                path = os.path.join(self.path, key + '.csv')
+                part.to_csv(path, mode='a', index=False, \
+                        header=not os.path.exists(path))
+            elif self.format == 'npy':
+                if (prop_mix, tau) in self.partitions:
+                    raise Exception, "Partition '%s' already written "\
+                            "('npy' partitions are written once)"%key
+                self._write_npy(key, part)
+            else:
+                store = pd.HDFStore(self.path, mode='a')
+                store.append(key, part, format='table', data_columns=True)
+                store.close()
+            if (prop_mix, tau) not in self.partitions:
+                self.partitions.append((prop_mix, tau))
+
+    def sync(self, prop_mix, tau):
+        '''
+        Flush the files of a partition (and the folder listing them) to
+        disk, so what was appended survives a crash of the machine
+        '''
+        if self.format == 'hdf':
+            _fsync(self.path)
+            return
+        key = self._key(prop_mix, tau)
+        names = [key + '.csv', key + '.json']
+        if self.format == 'npy' and (prop_mix, tau) in self.partitions:
+            names.append(self._counts_file(key))
+        for name in names:
+            path = os.path.join(self.path, name)
+            if os.path.exists(path):
+                _fsync(path)
+        _fsync(self.path)
+
+    def drop(self, prop_mix, tau):
+        '''
+        Remove the partition of a cell (e.g. if its tau is pruned after it
+        was written)
+        '''
+        key = self._key(prop_mix, tau)
+        if self.format == 'csv':
+            path = os.path.join(self.path, key + '.csv')
+            if os.path.exists(path):
+                os.remove(path)
+        elif self.format == 'npy':
+            path = os.path.join(self.path, key + '.json')
+            if os.path.exists(path):
+                counts = os.path.join(self.path, self._counts_file(key))
+                # The .json goes first, so the partition is never listed
+                # without its counts
+                os.remove(path)
+                if os.path.exists(counts):
+                    os.remove(counts)
+        else:
+            store = pd.HDFStore(self.path, mode='a')
+            if key in store:
+                store.remove(key)
+            store.close()
+        if (prop_mix, tau) in self.partitions:
+            self.partitions.remove((prop_mix, tau))
+
+    def read(self, prop_mix=None, tau=None):
+        '''
+        Read what has been written so far (optionally only one proportions
+        and/or tau) in the format returned by `god_multi_reps`
+        '''
+        keys = [k for k in self._keys() if \
+                (prop_mix is None or self._unkey(k)[0] == prop_mix) and \
+                (tau is None or self._unkey(k)[1] == tau)]
+        if not keys:
+            return None
+        if self.format == 'csv':
+            parts = [pd.read_csv(os.path.join(self.path, k + '.csv')) \
+                    for k in keys]
+        elif self.format == 'npy':
+            parts = map(self._read_npy, keys)
+        else:
+            store = pd.HDFStore(self.path, mode='r')
+            parts = [store.select(k) for k in keys]
+            store.close()
+        return index_output(pd.concat(parts))
+
+    def load(self, prop_mix, tau, mmap_mode='r'):
+        '''
+        Counts and metadata of a partition written in 'npy' format, without
+        building a table
+        ...
+
+        Arguments
+        ---------
+        prop_mix    : str
+                      Proportions of the cell
+        tau         : float
+                      Tau of the cell
+        mmap_mode   : str
+                      [Optional. Default='r'] Passed to `np.load` (None
+                      loads counts in memory)
+
+        Returns
+        -------
+        counts      : ndarray
+                      (rep, neighborhood, group) counts. Replications
+                      that did not converge are stored as 0 (see 'happy'
+                      to tell them apart) and read as NaN in a table
+        meta        : dict
+                      'rep_id', 'neigh' and 'group' labels of every axis,
+                      'happy' (convergence of every replication) and
+                      'columns', with the rest of per-replication columns
+                      (e.g. 'ticks', 'seed')
+        '''
+        return self._load_npy(self._key(prop_mix, tau), mmap_mode)
+
+    def _load_npy(self, key, mmap_mode='r'):
+        fo = open(os.path.join(self.path, key + '.json'))
+        meta = json.load(fo)
+        fo.close()
+        # Partitions written before the .json named its counts use key.npy
+        counts = np.load(os.path.join(self.path, \
+                meta.get('counts', key + '.npy')), mmap_mode=mmap_mode)
+        return counts, meta
+
+    def _counts_file(self, key):
+        fo = open(os.path.join(self.path, key + '.json'))
+        meta = json.load(fo)
+        fo.close()
+        return meta.get('counts', key + '.npy')
+
+    def _write_npy(self, key, part):
+        groups = sorted(group_columns(part))
+        extra = [col for col in part.columns if col not in \
+                groups + ['group', 'rep_id', 'tau', 'prop_mix']]
+        if [col for col in extra if col not in META_COLUMNS]:
+            raise Exception, "'npy' sinks only store counts, not indices"
+
+        rep_ids = list(pd.unique(part['rep_id']))
+        neighs = sorted(pd.unique(part['group']), key=_neigh_order)
+        part = part.set_index(['rep_id', 'group'])
+        reps = part[extra].groupby(level='rep_id').first().loc[rep_ids]
+        happy = part[groups].notnull().all(axis=1).groupby(level='rep_id')\
+                .all().loc[rep_ids]
+        full = pd.MultiIndex.from_product([rep_ids, neighs])
+        counts = part[groups].reindex(full).fillna(0).values
+        dtype = np.uint16 if counts.max() < 2**16 else np.uint32
+        counts = counts.astype(dtype).reshape((len(rep_ids), len(neighs), \
+                len(groups)))
+        counts_file = '%s.%s.npy'%(key, os.urandom(4).encode('hex'))
+        meta = {'prop_mix': part['prop_mix'].iloc[0], \
+                'counts': counts_file, \
+                'tau': float(part['tau'].iloc[0]), \
+                'rep_id': np.array(rep_ids).tolist(), \
+                'neigh': neighs, \
+                'group': groups, \
+                'happy': happy.values.tolist(), \
+                'columns': {col: reps[col].values.tolist() for col in extra}}
+        # Counts go to a fresh file named in the .json, and renaming the
+        # .json into place is the only step that publishes the partition,
+        # so a crash never pairs labels with counts they do not describe
+        path = os.path.join(self.path, key)
+        np.save(os.path.join(self.path, counts_file), counts)
+        fo = open(path + '.json.tmp', 'w')
+        json.dump(meta, fo)
+        fo.flush()
+        os.fsync(fo.fileno())
+        fo.close()
+        os.rename(path + '.json.tmp', path + '.json')
+
+    def _read_npy(self, key):
+        counts, meta = self._load_npy(key)
+        r, n, g = counts.shape
+        tab = pd.DataFrame(counts.reshape((r * n, g)).astype(float), \
+                columns=meta['group'])
+        tab.loc[np.repeat(~np.array(meta['happy'], dtype=bool), n), :] = \
+                np.nan
+        tab['group'] = np.tile(meta['neigh'], r)
+        tab['rep_id'] = np.repeat(meta['rep_id'], n)
+        for col in meta['columns']:
+            tab[col] = np.repeat(meta['columns'][col], n)
+        tab['tau'] = meta['tau']
+        tab['prop_mix'] = meta['prop_mix']
+        return tab
+
+    def _keys(self):
+        if self.format == 'csv':
+            return sorted([f[:-4] for f in os.listdir(self.path) \
+                    if f.endswith('.csv')])
+        if self.format == 'npy':
+            return sorted([f[:-5] for f in os.listdir(self.path) \
+                    if f.endswith('.json')])
+        if not os.path.exists(self.path):
+            return []
+        store = pd.HDFStore(self.path, mode='r')
+        keys = sorted([k.strip('/') for k in store.keys()])
+        store.close()
+        return keys
+
+    def _key(self, prop_mix, tau):
+        # Valid both as file name and HDF5 node name
+        return 'p%s_t%s'%(prop_mix.replace('.', 'd'), \
+                repr(float(tau)).replace('.', 'd').replace('-', 'm'))
+
+    def _unkey(self, key):
+        prop_mix, tau = key[1:].split('_t')
+        return prop_mix.replace('d', '.'), \
+                float(tau.replace('d', '.').replace('m', '-'))
+
+def _neigh_order(neigh):
+    '''
+    Sort key of neighborhood labels, numeric on their trailing digits so
+    'n10' comes after 'n9'
+    '''
+    digits = re.search(r'(\d+)$', str(neigh))
+    if digits is None:
+        return (str(neigh), -1)
+    return (str(neigh)[:digits.start()], int(digits.group(1)))
+
+# Columns of the output that are neither counts nor indices
+META_COLUMNS = ['group', 'rep_id', 'ticks', 'seed', 'reps', 'tau', 'prop_mix']
+
+def _fsync(path):
+    '''
+    Flush a file or folder to disk
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def group_columns(tab):
+    '''
+    Columns with counts for every group ('g0', 'g1'...) in a table of output
+    '''
+    return [col for col in tab.columns if re.match(r'g\d+$', str(col))]
+
+def converged(tab):
+    '''
+    Series indexed on rep_id with whether every replication in a table of
+    output converged (counts and indices of those that did not are blanked)
+    '''
+    cols = [col for col in tab.columns if col not in META_COLUMNS]
+    return tab[cols].notnull().any(axis=1).groupby(tab['rep_id'].values).any()
+
+def index_output(out):
+    '''
+    Index flat simulation output (with 'tau', 'prop_mix', 'rep_id' and
+    'group' columns) on those four, in that order
+    '''
+    return out.set_index(['tau', 'prop_mix', 'rep_id', 'group'])
+
+class Checkpoint():
+    '''
+    Durable record of the tasks of a sweep already run, so a restarted
+    `god_multi_reps` only runs the missing ones. Output of every task is
+    appended to a `ResultSink` under `folder`, flushed to disk, and only
+    then logged in `folder/manifest.csv` (one line per replication, also
+    flushed to disk), so the manifest never lists a replication whose
+    output was lost. A line left incomplete by a crash while logging is
+    dropped on restart (its replications are run again)
+    ...
+
+    Arguments
+    ---------
+    folder      : str
+                  Folder to keep the checkpoint in (created if it does not
+                  exist, reused if it does)
+
+    Attributes
+    ----------
+    done        : dict
+                  Mapping of (prop_mix, tau, rep_id) of replications run to
+                  whether they converged
+    '''
+    def __init__(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.tasks = ResultSink(os.path.join(folder, 'tasks'))
+        _fsync(folder)
+        self.manifest = os.path.join(folder, 'manifest.csv')
+        self.done = {}
+        if os.path.exists(self.manifest):
+            self._read_manifest()
+
+    def _read_manifest(self):
+        '''
+        Load the manifest into `done`, truncating it before a torn last
+        line (a crash while logging)
+        '''
+        lines = open(self.manifest).read().split('\n')
+        good = 0
+        for i, line in enumerate(lines):
+            if not line:
+                good += 1
+                continue
+            try:
+                prop_mix, tau, rep_id, happy = line.split(',')
+                entry = (prop_mix, float(tau), int(rep_id))
+                happy = {'0': False, '1': True}[happy]
+            except (ValueError, KeyError):
+                if i < len(lines) - 1:
+                    raise Exception, "Line %i of %s not understood: '%s'"\
+                            %(i + 1, self.manifest, line)
+                fo = open(self.manifest, 'r+')
+                fo.truncate(good)
+                fo.close()
+                break
+            if i == len(lines) - 1:
+                # Complete fields but no line end: add it before appending
+                fo = open(self.manifest, 'a')
+                fo.write('\n')
+                fo.close()
+            self.done[entry] = happy
+            good += len(line) + 1
+
+    def record(self, tab, prop_mix, tau):
+        '''
+        Store the output `tab` of a task (as returned by `run_rep_multi` or
+        `run_batch_multi`) and log its replications as done
+        '''
+        tab = tab.copy()
+        tab['tau'] = tau
+        tab['prop_mix'] = prop_mix
+        self.tasks.append(tab)
+        self.tasks.sync(prop_mix, tau)
+        lines = []
+        for rep_id, happy in converged(tab).iteritems():
+            self.done[(prop_mix, float(tau), int(rep_id))] = happy
+            lines.append('%s,%r,%i,%i\n'%(prop_mix, float(tau), rep_id, happy))
+        new = not os.path.exists(self.manifest)
+        fo = open(self.manifest, 'a')
+        fo.writelines(lines)
+        fo.flush()
+        os.fsync(fo.fileno())
+        fo.close()
+        if new:
+            _fsync(self.folder)
+
+    def completed(self, prop_mix, tau):
+        '''
+        IDs of the replications run for a cell
+        '''
+        return set([rep_id for p, t, rep_id in self.done \
+                if p == prop_mix and t == float(tau)])
+
+    def load(self, prop_mix, tau):
+        '''
+        Output of the replications run for a cell, in the format of the
+        output of a task (None if there are none)
+        '''
+        done = self.completed(prop_mix, tau)
+        if not done:
+            return None
+        tab = self.tasks.read(prop_mix=prop_mix, tau=float(tau)).reset_index()
+        tab = tab[tab['rep_id'].isin(done)]
+        # A task stored but not logged before a crash may be run again
+        tab = tab.drop_duplicates(['rep_id', 'group'], take_last=True)
+        return tab.drop(['tau', 'prop_mix'], axis=1).set_index('group')